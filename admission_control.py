@@ -0,0 +1,166 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRejected(Exception):
+    """Запрос отклонен до обращения к БД; retry_after — рекомендуемая пауза в секундах"""
+
+    def __init__(self, route: str, reason: str, retry_after: int):
+        super().__init__(f"{route}: {reason}")
+        self.route = route
+        self.reason = reason
+        self.retry_after = retry_after
+
+class RouteLimiter:
+    """
+    Ограничение параллельности одного маршрута: не более max_concurrency
+    запросов одновременно работают с БД, остальные ждут в очереди FIFO
+    длиной не более max_queue.
+
+    Ожидаемое ожидание оценивается по позиции в очереди и скользящему
+    среднему времени обработки. Если оно больше оставшегося бюджета
+    клиента, запрос отклоняется сразу, а не после таймаута пула соединений.
+    """
+
+    def __init__(self, route: str, max_concurrency: int, max_queue: int,
+                 initial_service_time: float = 0.05, smoothing: float = 0.2):
+        self.route = route
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._service_time = initial_service_time
+        self._smoothing = smoothing
+        self._active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def expected_wait(self, position: int) -> float:
+        """Оценка ожидания для запроса на позиции position (с 1) в очереди"""
+        return math.ceil(position / self._max_concurrency) * self._service_time
+
+    async def acquire(self, deadline: float) -> float:
+        """Занимает слот до deadline (time.monotonic()); возвращает время ожидания"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._active = 0
+            self._waiters = deque()
+
+        if self._active < self._max_concurrency and not self._waiters:
+            self._active += 1
+            return 0.0
+
+        position = len(self._waiters) + 1
+        expected = self.expected_wait(position)
+        if len(self._waiters) >= self._max_queue:
+            raise AdmissionRejected(self.route, "queue_full", self._retry_after(expected))
+
+        budget = deadline - time.monotonic()
+        if expected > budget:
+            raise AdmissionRejected(self.route, "deadline", self._retry_after(expected))
+
+        started = time.monotonic()
+        future = loop.create_future()
+        self._waiters.append(future)
+        try:
+            # Слот передается ожидающему в release(), счетчик _active не меняется
+            await asyncio.wait_for(future, budget)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Слот передан одновременно с таймаутом: возвращаем его следующему
+                self.release()
+            raise AdmissionRejected(self.route, "timeout", self._retry_after(expected))
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Запрос отменен (клиент отключился) уже после передачи слота
+                self.release()
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                try:
+                    self._waiters.remove(future)
+                except ValueError:
+                    pass
+        return time.monotonic() - started
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        if service_time is not None:
+            self._service_time += self._smoothing * (service_time - self._service_time)
+
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def _retry_after(self, expected: float) -> int:
+        return max(1, math.ceil(expected))
+
+class AdmissionController:
+    """
+    Лимитеры маршрутов, работающих с БД. Запросы, обслуженные из кэша,
+    слот не занимают, поэтому при перегрузке они не стоят в очереди
+    за промахами кэша.
+    """
+
+    def __init__(self, limits: Dict[str, int], max_queue: int, default_timeout_ms: int,
+                 enabled: bool = True,
+                 on_wait: Optional[Callable[[str, float], None]] = None,
+                 on_queue_depth: Optional[Callable[[str, int], None]] = None,
+                 on_shed: Optional[Callable[[str, str], None]] = None):
+        self.enabled = enabled
+        self._limiters = {
+            route: RouteLimiter(route, max_concurrency, max_queue)
+            for route, max_concurrency in limits.items()
+        }
+        self._default_timeout = default_timeout_ms / 1000
+        self._on_wait = on_wait
+        self._on_queue_depth = on_queue_depth
+        self._on_shed = on_shed
+
+    def deadline(self, timeout_ms: Optional[int] = None) -> float:
+        """Крайний срок по бюджету клиента (мс) или по умолчанию"""
+        timeout = timeout_ms / 1000 if timeout_ms else self._default_timeout
+        return time.monotonic() + timeout
+
+    @asynccontextmanager
+    async def slot(self, route: str, deadline: float):
+        """Выполняет блок в слоте маршрута или выбрасывает AdmissionRejected"""
+        limiter = self._limiters.get(route)
+        if not self.enabled or limiter is None:
+            yield
+            return
+
+        try:
+            waited = await limiter.acquire(deadline)
+        except AdmissionRejected as e:
+            logger.warning(f"Запрос к {route} отклонен: {e.reason}")
+            if self._on_shed is not None:
+                self._on_shed(route, e.reason)
+            raise
+        finally:
+            self._report_queue_depth(limiter)
+
+        if self._on_wait is not None:
+            self._on_wait(route, waited)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            limiter.release(time.monotonic() - started)
+            self._report_queue_depth(limiter)
+
+    def _report_queue_depth(self, limiter: RouteLimiter) -> None:
+        if self._on_queue_depth is not None:
+            self._on_queue_depth(limiter.route, limiter.queue_depth)
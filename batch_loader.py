@@ -0,0 +1,90 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+BatchFunction = Callable[[List[Hashable], Any], Awaitable[Dict[Hashable, Any]]]
+
+class BatchLoader:
+    """
+    Загрузчик в стиле DataLoader: запросы ключей, пришедшие в течение
+    window_ms, объединяются в один вызов batch_fn.
+
+    batch_fn(keys, context) возвращает словарь ключ -> значение; ключи,
+    которых нет в словаре, разрешаются в None. В качестве context
+    передается контекст первого запроса пачки (например, сессия БД) —
+    он гарантированно жив, пока его владелец ждет результат.
+    """
+
+    def __init__(self, batch_fn: BatchFunction, window_ms: float = 2.0, max_batch_size: int = 100):
+        self._batch_fn = batch_fn
+        self._window = window_ms / 1000
+        self._max_batch_size = max_batch_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._context: Any = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    async def load(self, key: Hashable, context: Any = None) -> Any:
+        """Загружает одно значение, объединяя запрос с соседними"""
+        # shield: отмена одного ожидающего не должна отменять общую загрузку
+        return await asyncio.shield(self._enqueue(key, context))
+
+    async def load_many(self, keys: Iterable[Hashable], context: Any = None) -> Dict[Hashable, Any]:
+        """Загружает несколько значений; результат содержит все запрошенные ключи"""
+        unique_keys = list(dict.fromkeys(keys))
+        futures = [asyncio.shield(self._enqueue(key, context)) for key in unique_keys]
+        values = await asyncio.gather(*futures)
+        return dict(zip(unique_keys, values))
+
+    def _enqueue(self, key: Hashable, context: Any) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Пачка от другого (уже остановленного) цикла событий не будет выполнена
+            self._reset(loop)
+
+        future = self._pending.get(key)
+        if future is not None:
+            return future
+
+        future = loop.create_future()
+        self._pending[key] = future
+        if self._context is None:
+            self._context = context
+
+        if len(self._pending) >= self._max_batch_size:
+            self._dispatch()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self._window, self._dispatch)
+        return future
+
+    def _reset(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._pending = {}
+        self._context = None
+        self._flush_handle = None
+
+    def _dispatch(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        pending, context = self._pending, self._context
+        self._reset(self._loop)
+        if pending:
+            self._loop.create_task(self._run_batch(pending, context))
+
+    async def _run_batch(self, pending: Dict[Hashable, asyncio.Future], context: Any) -> None:
+        keys = list(pending)
+        try:
+            results = await self._batch_fn(keys, context)
+        except Exception as e:
+            logger.error(f"Batch load failed for {len(keys)} keys: {str(e)}")
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        logger.debug(f"Batch loaded {len(keys)} keys")
+        for key, future in pending.items():
+            if not future.done():
+                future.set_result(results.get(key))
@@ -0,0 +1,112 @@
+"""
+Время холодного старта: от запуска процесса до первого обслуженного запроса.
+
+Режимы:
+    uvicorn — запускает `python -m uvicorn main:app` и опрашивает GET /health;
+    asgi    — в новом процессе импортирует main, проходит lifespan через
+              TestClient и выполняет GET /health (без сетевого стека).
+
+Запуск (из корня проекта):
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --mode asgi --runs 10
+
+По умолчанию прогрев кэша отключен и используется SQLite, чтобы замер
+не зависел от доступности Postgres; --warmup оставляет настройки окружения.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ASGI_CHILD = """
+from fastapi.testclient import TestClient
+import main
+with TestClient(main.app) as client:
+    response = client.get("/health")
+    assert response.status_code == 200
+print("served")
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Время холодного старта до первого запроса")
+    parser.add_argument("--mode", choices=["uvicorn", "asgi"], default="uvicorn")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", action="store_true", help="Не отключать прогрев кэша")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    return parser.parse_args()
+
+def child_env(warmup: bool) -> dict:
+    env = dict(os.environ)
+    if not warmup:
+        env["CACHE_WARMUP_ENABLED"] = "False"
+        env.setdefault("DATABASE_URL", "sqlite:///./bench_startup.db")
+    env.setdefault("DEBUG", "False")
+    env.setdefault("LOG_LEVEL", "WARNING")
+    return env
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def run_uvicorn(env: dict, timeout: float) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=PROJECT_DIR,
+        env=env
+    )
+    try:
+        url = f"http://127.0.0.1:{port}/health"
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise TimeoutError("Сервер не ответил за отведенное время")
+    finally:
+        process.terminate()
+        process.wait()
+
+def run_asgi(env: dict, timeout: float) -> float:
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", ASGI_CHILD],
+        cwd=PROJECT_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+        check=True
+    ).stdout
+    elapsed = time.perf_counter() - start
+    assert "served" in output
+    return elapsed
+
+def main():
+    args = parse_args()
+    env = child_env(args.warmup)
+    run = run_uvicorn if args.mode == "uvicorn" else run_asgi
+    
+    timings = []
+    for i in range(args.runs):
+        elapsed = run(env, args.timeout)
+        timings.append(elapsed)
+        print(f"Запуск {i + 1}: {elapsed * 1000:.0f}мс")
+    
+    print(f"Режим: {args.mode}, запусков: {args.runs}, "
+          f"медиана: {statistics.median(timings) * 1000:.0f}мс, "
+          f"мин: {min(timings) * 1000:.0f}мс, макс: {max(timings) * 1000:.0f}мс")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,153 @@
 import json
 import asyncio
-from typing import Optional, Any, Dict
+import heapq
+import mmap
+import os
+import pickle
+import struct
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, Optional, Any, Dict, List, Set, Tuple
 from datetime import datetime, timedelta
 import logging
 
+from timing_service import timing_service
+
 logger = logging.getLogger(__name__)
 
+# Формат снимка кэша: заголовок, затем записи подряд.
+# Запись: expires_at (unix time), длины ключа, ETag и значения, затем сами байты.
+SNAPSHOT_MAGIC = b"OMSCACHE"
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct("<8sII")
+_SNAPSHOT_RECORD = struct.Struct("<dHHI")
+
+# Размер значения оценивается по типу; оценка типа уточняется pickle каждой N-й записи
+SIZE_SAMPLE_EVERY = 64
+
+@dataclass
+class PrefixStats:
+    """Счетчики кэша для одного префикса ключей"""
+    keys: int = 0
+    bytes: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+def _key_prefix(key: str) -> str:
+    return key.split(":", 1)[0]
+
 class CacheService:
-    def __init__(self):
+    """
+    In-memory кэш с TTL.
+
+    Статистика ведется инкрементально по префиксу ключа (order_full,
+    nomenclature_full, ...): каждая операция обновляет счетчики, поэтому
+    get_cache_stats() не обходит записи. Размер записи берется из средней
+    длины pickle значений того же типа: pickle выполняется для первой
+    записи типа и затем для каждой SIZE_SAMPLE_EVERY-й записи.
+
+    Истекшие записи удаляются при обращении к ним. До этого их находит
+    куча сроков истечения: get_cache_stats() снимает с нее только записи,
+    истекшие с прошлого вызова, и считает их в expired_keys.
+    """
+
+    def __init__(self, on_hit: Optional[Callable[[str], None]] = None,
+                 on_miss: Optional[Callable[[str], None]] = None):
         self._cache: Dict[str, Dict[str, Any]] = {}
         self._default_ttl = 300  # 5 минут по умолчанию
+        self._stats: Dict[str, PrefixStats] = {}
+        self._total_bytes = 0
+        self._type_sizes: Dict[type, int] = {}
+        self._writes = 0
+        self._expiry_heap: List[Tuple[datetime, str]] = []
+        self._expired: Set[str] = set()
+        self._on_hit = on_hit
+        self._on_miss = on_miss
+    
+    def _prefix_stats(self, key: str) -> Tuple[str, PrefixStats]:
+        prefix = _key_prefix(key)
+        stats = self._stats.get(prefix)
+        if stats is None:
+            stats = self._stats[prefix] = PrefixStats()
+        return prefix, stats
+    
+    def _record_hit(self, key: str) -> None:
+        prefix, stats = self._prefix_stats(key)
+        stats.hits += 1
+        if self._on_hit is not None:
+            self._on_hit(prefix)
+    
+    def _record_miss(self, key: str) -> None:
+        prefix, stats = self._prefix_stats(key)
+        stats.misses += 1
+        if self._on_miss is not None:
+            self._on_miss(prefix)
+    
+    def _store(self, key: str, entry: Dict[str, Any], size: Optional[int] = None) -> None:
+        """Сохраняет запись и обновляет счетчики ключей и байт"""
+        if size is None:
+            size = len(key) + len(entry.get('etag') or '') + self._estimate_size(entry['value'])
+        entry['size'] = size
+        
+        _, stats = self._prefix_stats(key)
+        previous = self._cache.get(key)
+        if previous is not None:
+            stats.bytes -= previous['size']
+            self._total_bytes -= previous['size']
+        else:
+            stats.keys += 1
+        stats.bytes += size
+        self._total_bytes += size
+        self._cache[key] = entry
+        
+        self._expired.discard(key)
+        heapq.heappush(self._expiry_heap, (entry['expires_at'], key))
+        if len(self._expiry_heap) > 2 * len(self._cache) + 1024:
+            self._compact_expiry_heap()
+    
+    def _remove(self, key: str, expired: bool = False) -> None:
+        """Удаляет запись: по истечении TTL или при инвалидации (eviction)"""
+        entry = self._cache.pop(key)
+        self._expired.discard(key)
+        _, stats = self._prefix_stats(key)
+        stats.keys -= 1
+        stats.bytes -= entry['size']
+        self._total_bytes -= entry['size']
+        if expired:
+            stats.expirations += 1
+        else:
+            stats.evictions += 1
+    
+    def _estimate_size(self, value: Any) -> int:
+        value_type = type(value)
+        size = self._type_sizes.get(value_type)
+        self._writes += 1
+        if size is None or self._writes % SIZE_SAMPLE_EVERY == 0:
+            sampled = _pickled_size(value)
+            size = sampled if size is None else (size * 3 + sampled) // 4
+            self._type_sizes[value_type] = size
+        return size
+    
+    def _compact_expiry_heap(self) -> None:
+        """Убирает из кучи элементы перезаписанных и удаленных записей"""
+        self._expiry_heap = [
+            (entry['expires_at'], key) for key, entry in self._cache.items()
+            if key not in self._expired
+        ]
+        heapq.heapify(self._expiry_heap)
+    
+    def _collect_expired(self) -> int:
+        """Переносит из кучи в _expired записи, истекшие с прошлого вызова"""
+        now = datetime.now()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry_heap)
+            entry = self._cache.get(key)
+            # Запись перезаписана с новым сроком или уже удалена: элемент кучи устарел
+            if entry is not None and entry['expires_at'] == expires_at:
+                self._expired.add(key)
+        return len(self._expired)
     
     def _is_expired(self, cache_entry: Dict[str, Any]) -> bool:
         """Проверяет, истек ли срок действия кэша"""
@@ -24,49 +162,107 @@ class CacheService:
             key_parts.append(f"{k}:{v}")
         return ":".join(key_parts)
     
-    async def get(self, key: str) -> Optional[Any]:
-        """Получает значение из кэша"""
+    async def get_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        """Получает запись кэша целиком (значение и ETag)"""
         if key not in self._cache:
+            self._record_miss(key)
             return None
         
         cache_entry = self._cache[key]
         if self._is_expired(cache_entry):
-            del self._cache[key]
+            self._remove(key, expired=True)
+            self._record_miss(key)
             logger.debug(f"Cache expired for key: {key}")
             return None
         
+        self._record_hit(key)
         logger.debug(f"Cache hit for key: {key}")
+        return cache_entry
+    
+    async def get_entries(self, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Получает несколько записей за один проход; отсутствующие ключи пропускаются"""
+        entries = {}
+        now = datetime.now()
+        for key in keys:
+            cache_entry = self._cache.get(key)
+            if cache_entry is None:
+                self._record_miss(key)
+                continue
+            if now > cache_entry['expires_at']:
+                self._remove(key, expired=True)
+                self._record_miss(key)
+                continue
+            self._record_hit(key)
+            entries[key] = cache_entry
+        
+        logger.debug(f"Cache multi-get: {len(entries)}/{len(keys)} hits")
+        return entries
+    
+    async def get(self, key: str) -> Optional[Any]:
+        """Получает значение из кэша"""
+        cache_entry = await self.get_entry(key)
+        if cache_entry is None:
+            return None
         return cache_entry['value']
     
-    async def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
-        """Сохраняет значение в кэш"""
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None, etag: Optional[str] = None) -> None:
+        """Сохраняет значение в кэш (вместе с ETag, если он известен)"""
         ttl = ttl or self._default_ttl
         expires_at = datetime.now() + timedelta(seconds=ttl)
         
-        self._cache[key] = {
+        self._store(key, {
             'value': value,
+            'etag': etag,
             'expires_at': expires_at,
             'created_at': datetime.now()
-        }
+        })
         
         logger.debug(f"Cache set for key: {key}, TTL: {ttl}s")
     
+    async def set_many(self, items: Dict[str, Tuple[Any, Optional[str]]], ttl: Optional[int] = None) -> None:
+        """Сохраняет несколько значений: ключ -> (значение, ETag)"""
+        ttl = ttl or self._default_ttl
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=ttl)
+        
+        for key, (value, etag) in items.items():
+            self._store(key, {
+                'value': value,
+                'etag': etag,
+                'expires_at': expires_at,
+                'created_at': now
+            })
+        
+        logger.debug(f"Cache multi-set: {len(items)} keys, TTL: {ttl}s")
+    
     async def delete(self, key: str) -> None:
         """Удаляет значение из кэша"""
         if key in self._cache:
-            del self._cache[key]
+            self._remove(key)
             logger.debug(f"Cache deleted for key: {key}")
     
     async def delete_pattern(self, pattern: str) -> None:
         """Удаляет все ключи, соответствующие паттерну"""
         keys_to_delete = [key for key in self._cache.keys() if pattern in key]
         for key in keys_to_delete:
-            del self._cache[key]
+            self._remove(key)
         logger.debug(f"Cache pattern deleted: {pattern}, keys: {len(keys_to_delete)}")
     
+    def clear(self) -> None:
+        """Очищает кэш; счетчики попаданий и промахов сохраняются"""
+        for stats in self._stats.values():
+            stats.evictions += stats.keys
+            stats.keys = 0
+            stats.bytes = 0
+        self._cache.clear()
+        self._total_bytes = 0
+        self._expiry_heap = []
+        self._expired.clear()
+    
     async def get_or_set(self, key: str, func, ttl: Optional[int] = None, *args, **kwargs) -> Any:
         """Получает значение из кэша или вычисляет и сохраняет"""
-        cached_value = await self.get(key)
+        with timing_service.phase("cache"):
+            cached_value = await self.get(key)
         if cached_value is not None:
             return cached_value
         
@@ -76,21 +272,109 @@ class CacheService:
         else:
             value = func(*args, **kwargs)
         
-        await self.set(key, value, ttl)
+        with timing_service.phase("cache"):
+            await self.set(key, value, ttl)
         return value
     
+    def save_snapshot(self, path: str) -> int:
+        """
+        Сохраняет живые записи кэша в бинарный файл (атомарно через rename).
+        Значения сериализуются pickle, поэтому файл снимка должен быть
+        доступен только самому сервису.
+        """
+        now = datetime.now()
+        now_ts = time.time()
+        records = []
+        for key, entry in self._cache.items():
+            if entry['expires_at'] <= now:
+                continue
+            expires_ts = now_ts + (entry['expires_at'] - now).total_seconds()
+            key_bytes = key.encode('utf-8')
+            etag_bytes = (entry.get('etag') or '').encode('utf-8')
+            value_bytes = pickle.dumps(entry['value'], protocol=pickle.HIGHEST_PROTOCOL)
+            records.append((expires_ts, key_bytes, etag_bytes, value_bytes))
+        
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(records)))
+            for expires_ts, key_bytes, etag_bytes, value_bytes in records:
+                f.write(_SNAPSHOT_RECORD.pack(expires_ts, len(key_bytes), len(etag_bytes), len(value_bytes)))
+                f.write(key_bytes)
+                f.write(etag_bytes)
+                f.write(value_bytes)
+        os.replace(tmp_path, path)
+        
+        logger.info(f"Cache snapshot saved: {path}, keys: {len(records)}")
+        return len(records)
+    
+    def load_snapshot(self, path: str) -> int:
+        """
+        Загружает снимок кэша через mmap. Оставшийся TTL каждой записи
+        пересчитывается от текущего времени, истекшие записи пропускаются.
+        """
+        if not os.path.exists(path) or os.path.getsize(path) < _SNAPSHOT_HEADER.size:
+            return 0
+        
+        now = datetime.now()
+        now_ts = time.time()
+        loaded = 0
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, count = _SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                logger.warning(f"Cache snapshot {path} has unsupported format, skipped")
+                return 0
+            
+            offset = _SNAPSHOT_HEADER.size
+            for _ in range(count):
+                expires_ts, key_len, etag_len, value_len = _SNAPSHOT_RECORD.unpack_from(data, offset)
+                offset += _SNAPSHOT_RECORD.size
+                key_end = offset + key_len
+                etag_end = key_end + etag_len
+                value_end = etag_end + value_len
+                
+                remaining = expires_ts - now_ts
+                if remaining > 0:
+                    key = data[offset:key_end].decode('utf-8')
+                    etag = data[key_end:etag_end].decode('utf-8') or None
+                    self._store(key, {
+                        'value': pickle.loads(data[etag_end:value_end]),
+                        'etag': etag,
+                        'expires_at': now + timedelta(seconds=remaining),
+                        'created_at': now
+                    }, size=key_len + etag_len + value_len)
+                    loaded += 1
+                offset = value_end
+        
+        logger.info(f"Cache snapshot loaded: {path}, keys: {loaded}")
+        return loaded
+    
     def get_cache_stats(self) -> Dict[str, Any]:
-        """Возвращает статистику кэша"""
-        total_keys = len(self._cache)
-        expired_keys = sum(1 for entry in self._cache.values() if self._is_expired(entry))
-        active_keys = total_keys - expired_keys
+        """
+        Возвращает статистику кэша за O(число префиксов + истекших с прошлого
+        вызова записей). Истекшие, но еще не удаленные записи входят
+        в total_keys и expired_keys, но не в active_keys.
+        """
+        expired_keys = self._collect_expired()
+        prefixes = {prefix: asdict(stats) for prefix, stats in self._stats.items()}
+        hits = sum(stats.hits for stats in self._stats.values())
+        misses = sum(stats.misses for stats in self._stats.values())
         
         return {
-            'total_keys': total_keys,
-            'active_keys': active_keys,
+            'total_keys': len(self._cache),
+            'active_keys': len(self._cache) - expired_keys,
             'expired_keys': expired_keys,
-            'memory_usage_mb': len(str(self._cache)) / 1024 / 1024
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else 0.0,
+            'evictions': sum(stats.evictions for stats in self._stats.values()),
+            'expirations': sum(stats.expirations for stats in self._stats.values()),
+            'memory_usage_mb': self._total_bytes / 1024 / 1024,
+            'prefixes': prefixes
         }
 
-# Глобальный экземпляр кэша
-cache_service = CacheService()
+def _pickled_size(value: Any) -> int:
+    """Размер значения в байтах по длине pickle"""
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
@@ -0,0 +1,70 @@
+import heapq
+from collections import Counter
+from typing import Dict, Sequence
+import logging
+
+from sqlalchemy.orm import Session
+
+import repository
+from cache_service import CacheService
+from config import Settings
+
+logger = logging.getLogger(__name__)
+
+async def warm_up_cache(shards: Sequence[Session], cache: CacheService, settings: Settings) -> Dict[str, int]:
+    """
+    Прогревает кэш перед приемом трафика: самые продаваемые товары
+    и последние активные заказы загружаются пачками и кладутся в кэш
+    вместе с ETag.
+
+    shards — сессии всех шардов (без шардирования — одна сессия). Продажи
+    и последние заказы выбираются в каждом шарде и объединяются; товары
+    читаются из первого шарда (справочники в шардах одинаковые), заказы —
+    из своего шарда. Топ товаров объединяется из топов шардов, поэтому
+    при шардировании он приблизительный.
+    """
+    sales = Counter()
+    recent_orders = []
+    for shard, db in enumerate(shards):
+        sales.update(repository.select_hot_nomenclature_sales(
+            db,
+            limit=settings.CACHE_WARMUP_NOMENCLATURE_LIMIT,
+            days=settings.CACHE_WARMUP_HOT_DAYS
+        ))
+        recent_orders += [
+            (order_date, order_id, shard)
+            for order_id, order_date in repository.select_recent_active_orders(
+                db, limit=settings.CACHE_WARMUP_ORDERS_LIMIT
+            )
+        ]
+    
+    nomenclature_ids = [
+        nomenclature_id for nomenclature_id, _ in sales.most_common(settings.CACHE_WARMUP_NOMENCLATURE_LIMIT)
+    ]
+    nomenclature = repository.load_nomenclature_infos(shards[0], nomenclature_ids)
+    await cache.set_many(
+        {
+            cache._generate_key("nomenclature_full", nomenclature_id=nomenclature_id): fetched
+            for nomenclature_id, fetched in nomenclature.items()
+        },
+        ttl=settings.CACHE_TTL_NOMENCLATURE
+    )
+    
+    order_ids_by_shard: Dict[int, list] = {}
+    for _, order_id, shard in heapq.nlargest(
+        settings.CACHE_WARMUP_ORDERS_LIMIT, recent_orders, key=lambda order: order[0]
+    ):
+        order_ids_by_shard.setdefault(shard, []).append(order_id)
+    orders = {}
+    for shard, order_ids in order_ids_by_shard.items():
+        orders.update(repository.load_order_infos(shards[shard], order_ids))
+    await cache.set_many(
+        {
+            cache._generate_key("order_full", order_id=order_id): fetched
+            for order_id, fetched in orders.items()
+        },
+        ttl=settings.CACHE_TTL_ORDERS
+    )
+    
+    logger.info(f"Cache warm-up finished: nomenclature: {len(nomenclature)}, orders: {len(orders)}")
+    return {"nomenclature": len(nomenclature), "orders": len(orders)}
@@ -1,6 +1,6 @@
 import os
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Optional, List
 
 load_dotenv()
 
@@ -11,6 +11,26 @@ class Settings:
     DB_USER: str = os.getenv("DB_USER", "orders_user")
     DB_PASSWORD: str = os.getenv("DB_PASSWORD", "orders_password")
     DB_NAME: str = os.getenv("DB_NAME", "orders_system")
+    DATABASE_URL: str = os.getenv("DATABASE_URL", "")  # переопределяет DB_* (например, sqlite:///./orders.db)
+    
+    # Read replica settings
+    REPLICA_DATABASE_URLS: str = os.getenv("REPLICA_DATABASE_URLS", "")  # URL реплик через запятую
+    REPLICA_STRATEGY: str = os.getenv("REPLICA_STRATEGY", "round_robin")  # round_robin | least_loaded
+    REPLICA_PIN_SECONDS: float = float(os.getenv("REPLICA_PIN_SECONDS", "5"))
+    REPLICA_MAX_LAG_SECONDS: float = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "10"))
+    REPLICA_LAG_CHECK_INTERVAL: float = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+    
+    # Statement cache settings
+    DB_QUERY_CACHE_SIZE: int = int(os.getenv("DB_QUERY_CACHE_SIZE", "500"))
+    # Серверные prepared statements (только драйвер psycopg 3, URL postgresql+psycopg://)
+    DB_PREPARE_THRESHOLD: int = int(os.getenv("DB_PREPARE_THRESHOLD", "5"))
+    
+    # Sharding settings: заказы шардируются по client_id, шард 0 — источник справочников
+    SHARD_DATABASE_URLS: str = os.getenv("SHARD_DATABASE_URLS", "")  # URL шардов через запятую
+    SHARD_ID_SCHEME: str = os.getenv("SHARD_ID_SCHEME", "modulo")  # modulo | lookup
+    SHARD_LOOKUP_CACHE_SIZE: int = int(os.getenv("SHARD_LOOKUP_CACHE_SIZE", "100000"))
+    # Период копирования справочников из шарда 0 в остальные; 0 — только при старте
+    SHARD_REFERENCE_SYNC_SECONDS: float = float(os.getenv("SHARD_REFERENCE_SYNC_SECONDS", "60"))
     
     # Application settings
     APP_HOST: str = os.getenv("APP_HOST", "0.0.0.0")
@@ -19,15 +39,60 @@ class Settings:
     
     # Security
     SECRET_KEY: str = os.getenv("SECRET_KEY", "your-secret-key-here")
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")  # пустой токен отключает admin-эндпоинты
     
     # Logging
     LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
     
+    # Profiling settings
+    SERVER_TIMING_ENABLED: bool = os.getenv("SERVER_TIMING_ENABLED", "True").lower() == "true"
+    PROFILER_MAX_SECONDS: int = int(os.getenv("PROFILER_MAX_SECONDS", "60"))
+    
     # Cache settings
     CACHE_TTL_DEFAULT: int = int(os.getenv("CACHE_TTL_DEFAULT", "300"))  # 5 минут
     CACHE_TTL_NOMENCLATURE: int = int(os.getenv("CACHE_TTL_NOMENCLATURE", "600"))  # 10 минут
     CACHE_TTL_ORDERS: int = int(os.getenv("CACHE_TTL_ORDERS", "60"))  # 1 минута
     
+    # Cache warm-up settings
+    CACHE_WARMUP_ENABLED: bool = os.getenv("CACHE_WARMUP_ENABLED", "True").lower() == "true"
+    CACHE_WARMUP_NOMENCLATURE_LIMIT: int = int(os.getenv("CACHE_WARMUP_NOMENCLATURE_LIMIT", "500"))
+    CACHE_WARMUP_ORDERS_LIMIT: int = int(os.getenv("CACHE_WARMUP_ORDERS_LIMIT", "500"))
+    CACHE_WARMUP_HOT_DAYS: int = int(os.getenv("CACHE_WARMUP_HOT_DAYS", "30"))
+    CACHE_SNAPSHOT_PATH: str = os.getenv("CACHE_SNAPSHOT_PATH", "")  # пустой путь отключает снимки
+    
+    # Batch loading settings
+    NOMENCLATURE_BATCH_WINDOW_MS: float = float(os.getenv("NOMENCLATURE_BATCH_WINDOW_MS", "2"))
+    NOMENCLATURE_BATCH_MAX_SIZE: int = int(os.getenv("NOMENCLATURE_BATCH_MAX_SIZE", "100"))
+    NOMENCLATURE_MULTI_GET_MAX_IDS: int = int(os.getenv("NOMENCLATURE_MULTI_GET_MAX_IDS", "100"))
+    
+    # Write settings
+    ADD_ITEM_WRITE_MODE: str = os.getenv("ADD_ITEM_WRITE_MODE", "direct")  # direct | group
+    GROUP_COMMIT_MAX_BATCH: int = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "100"))
+    GROUP_COMMIT_INTERVAL_MS: float = float(os.getenv("GROUP_COMMIT_INTERVAL_MS", "5"))
+    ORDER_WRITE_MAX_RETRIES: int = int(os.getenv("ORDER_WRITE_MAX_RETRIES", "3"))
+    
+    # Nomenclature search settings
+    NOMENCLATURE_SEARCH_BACKEND: str = os.getenv("NOMENCLATURE_SEARCH_BACKEND", "memory")  # memory | db
+    # Период фонового обновления in-memory индекса поиска
+    NOMENCLATURE_SEARCH_REFRESH_SECONDS: float = float(os.getenv("NOMENCLATURE_SEARCH_REFRESH_SECONDS", "5"))
+    NOMENCLATURE_SEARCH_MAX_LIMIT: int = int(os.getenv("NOMENCLATURE_SEARCH_MAX_LIMIT", "100"))
+    
+    # Admission control settings
+    ADMISSION_CONTROL_ENABLED: bool = os.getenv("ADMISSION_CONTROL_ENABLED", "True").lower() == "true"
+    # Лимиты маршрутов в сумме не должны превышать пул SQLAlchemy (5 + 10 overflow)
+    # Лимит записи действует в режиме direct; в режиме group записи ограничивает очередь писателя
+    ADMISSION_ADD_ITEM_CONCURRENCY: int = int(os.getenv("ADMISSION_ADD_ITEM_CONCURRENCY", "8"))
+    ADMISSION_ORDER_READ_CONCURRENCY: int = int(os.getenv("ADMISSION_ORDER_READ_CONCURRENCY", "6"))
+    ADMISSION_MAX_QUEUE: int = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+    ADMISSION_DEFAULT_TIMEOUT_MS: int = int(os.getenv("ADMISSION_DEFAULT_TIMEOUT_MS", "2000"))
+    
+    # Idempotency settings
+    IDEMPOTENCY_BACKEND: str = os.getenv("IDEMPOTENCY_BACKEND", "memory")  # memory | redis
+    IDEMPOTENCY_TTL_SECONDS: int = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))  # 24 часа
+    IDEMPOTENCY_MAX_ENTRIES: int = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "100000"))
+    # Период удаления истекших строк idempotency_keys; 0 — не удалять из приложения
+    IDEMPOTENCY_PURGE_INTERVAL_SECONDS: int = int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "3600"))
+    
     # Redis settings (для будущего использования)
     REDIS_HOST: str = os.getenv("REDIS_HOST", "localhost")
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", "6379"))
@@ -35,8 +100,18 @@ class Settings:
     
     @property
     def database_url(self) -> str:
+        if self.DATABASE_URL:
+            return self.DATABASE_URL
         return f"postgresql://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
     
+    @property
+    def replica_database_urls(self) -> List[str]:
+        return [url.strip() for url in self.REPLICA_DATABASE_URLS.split(",") if url.strip()]
+    
+    @property
+    def shard_database_urls(self) -> List[str]:
+        return [url.strip() for url in self.SHARD_DATABASE_URLS.split(",") if url.strip()]
+    
     @property
     def redis_url(self) -> str:
         if self.REDIS_PASSWORD:
@@ -1,10 +1,33 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Enum, Numeric
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Enum, Numeric, UniqueConstraint, text
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, Session
+from fastapi import Depends, Request
 from datetime import datetime
-from config import settings
+from collections import OrderedDict
+from typing import Optional, List, Dict, Hashable, Tuple
+import itertools
+import logging
+import time
+from config import Settings
+
+logger = logging.getLogger(__name__)
+
+def _create_engine(url: str, echo: bool = False, prepare_threshold: Optional[int] = None,
+                   query_cache_size: int = 500):
+    """
+    Создает engine; для SQLite разрешает использование из разных потоков.
+    
+    query_cache_size — размер кэша скомпилированных выражений SQLAlchemy.
+    prepare_threshold включает серверные prepared statements драйвера
+    psycopg 3 (postgresql+psycopg://): запрос, выполненный столько раз
+    в соединении, готовится на сервере. psycopg2 их не поддерживает.
+    """
+    connect_args = {}
+    if url.startswith("sqlite"):
+        connect_args["check_same_thread"] = False
+    elif url.startswith("postgresql+psycopg:") and prepare_threshold is not None:
+        connect_args["prepare_threshold"] = prepare_threshold
+    return create_engine(url, echo=echo, connect_args=connect_args, query_cache_size=query_cache_size)
 
-engine = create_engine(settings.database_url, echo=settings.DEBUG)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 class Category(Base):
     __tablename__ = "categories"
@@ -51,14 +74,22 @@ class Order(Base):
     order_date = Column(DateTime, default=datetime.utcnow)
     status = Column(Enum('pending', 'processing', 'completed', 'cancelled', name='order_status'), default='pending')
     total_amount = Column(Numeric(10, 2), default=0)
+    version = Column(Integer, nullable=False, default=1)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     client = relationship("Client", back_populates="orders")
     order_items = relationship("OrderItem", back_populates="order")
+    
+    # Оптимистическая блокировка: ORM-обновления заказа проверяют и увеличивают version;
+    # SQL-инкременты суммы увеличивают ее явно. version — источник ETag заказа
+    __mapper_args__ = {"version_id_col": version}
 
 class OrderItem(Base):
     __tablename__ = "order_items"
+    __table_args__ = (
+        UniqueConstraint("order_id", "nomenclature_id", name="uq_order_items_order_nomenclature"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
@@ -71,9 +102,370 @@ class OrderItem(Base):
     order = relationship("Order", back_populates="order_items")
     nomenclature = relationship("Nomenclature", back_populates="order_items")
 
-def get_db():
-    db = SessionLocal()
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    response = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+def _lsn_to_int(lsn: str) -> int:
+    """Переводит LSN Postgres вида 'X/Y' в число"""
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+class _Replica:
+    def __init__(self, url: str, echo: bool = False, engine_options: Optional[Dict] = None):
+        self.url = url
+        self.engine = _create_engine(url, echo=echo, **(engine_options or {}))
+        self.session_factory = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.is_postgres = self.engine.dialect.name == "postgresql"
+        self.lag_seconds = 0.0
+        self.lag_checked_at = 0.0
+
+    @property
+    def load(self) -> int:
+        """Количество выданных соединений пула"""
+        checkedout = getattr(self.engine.pool, "checkedout", None)
+        return checkedout() if checkedout else 0
+
+class ReplicaRouter:
+    """
+    Маршрутизация чтений по репликам.
+    
+    Чтения распределяются по репликам (round_robin или least_loaded),
+    записи всегда идут в primary. После записи ключ (например, заказ)
+    закрепляется: пока не истек REPLICA_PIN_SECONDS, чтения по нему идут
+    в primary или в реплику, уже воспроизведшую WAL до LSN записи.
+    Реплики с отставанием больше REPLICA_MAX_LAG_SECONDS пропускаются.
+    Для не-Postgres баз (например, SQLite-файлов при локальной проверке)
+    LSN и отставание недоступны, и закрепленные чтения идут в primary.
+    """
+
+    MAX_PINS = 100_000
+
+    def __init__(self, replica_urls: List[str], strategy: str = "round_robin", pin_seconds: float = 5.0,
+                 max_lag_seconds: float = 10.0, lag_check_interval: float = 5.0, echo: bool = False,
+                 engine_options: Optional[Dict] = None):
+        self.replicas = [_Replica(url, echo=echo, engine_options=engine_options) for url in replica_urls]
+        self._strategy = strategy
+        self._pin_seconds = pin_seconds
+        self._max_lag_seconds = max_lag_seconds
+        self._lag_check_interval = lag_check_interval
+        self._round_robin = itertools.count()
+        self._pins: Dict[Hashable, Tuple[Optional[int], float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def mark_written(self, key: Hashable, db: Session) -> None:
+        """Закрепляет чтения по ключу за primary после записи"""
+        if not self.enabled:
+            return
+        lsn = None
+        if db.get_bind().dialect.name == "postgresql":
+            lsn = _lsn_to_int(db.execute(text("SELECT pg_current_wal_lsn()::text")).scalar())
+        now = time.monotonic()
+        if len(self._pins) >= self.MAX_PINS:
+            self._pins = {pin_key: pin for pin_key, pin in self._pins.items() if pin[1] >= now}
+        self._pins[key] = (lsn, now + self._pin_seconds)
+
+    def read_session(self, key: Optional[Hashable] = None) -> Optional[Session]:
+        """Возвращает сессию реплики или None, если читать нужно из primary"""
+        if not self.enabled:
+            return None
+
+        pin = self._pins.get(key) if key is not None else None
+        if pin is not None and pin[1] < time.monotonic():
+            self._pins.pop(key, None)
+            pin = None
+
+        for replica in self._candidates():
+            if pin is not None and not self._has_replayed(replica, pin[0]):
+                continue
+            return replica.session_factory()
+
+        return None
+
+    def _candidates(self) -> List[_Replica]:
+        healthy = [replica for replica in self.replicas if self._lag_ok(replica)]
+        if self._strategy == "least_loaded":
+            return sorted(healthy, key=lambda replica: replica.load)
+        if not healthy:
+            return []
+        start = next(self._round_robin) % len(healthy)
+        return healthy[start:] + healthy[:start]
+
+    def _lag_ok(self, replica: _Replica) -> bool:
+        if not replica.is_postgres:
+            return True
+        now = time.monotonic()
+        if now - replica.lag_checked_at >= self._lag_check_interval:
+            replica.lag_checked_at = now
+            try:
+                with replica.engine.connect() as connection:
+                    lag = connection.execute(text(
+                        "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+                    )).scalar()
+                replica.lag_seconds = float(lag)
+            except Exception as e:
+                logger.warning(f"Replica lag check failed for {replica.engine.url!r}: {str(e)}")
+                replica.lag_seconds = float("inf")
+        return replica.lag_seconds <= self._max_lag_seconds
+
+    def _has_replayed(self, replica: _Replica, lsn: Optional[int]) -> bool:
+        """Проверяет, что реплика воспроизвела WAL до LSN записи"""
+        if lsn is None or not replica.is_postgres:
+            return False
+        try:
+            with replica.engine.connect() as connection:
+                replayed = connection.execute(text("SELECT pg_last_wal_replay_lsn()::text")).scalar()
+        except Exception as e:
+            logger.warning(f"Replica LSN check failed for {replica.engine.url!r}: {str(e)}")
+            return False
+        return replayed is not None and _lsn_to_int(replayed) >= lsn
+
+    def dispose(self) -> None:
+        """Закрывает пулы соединений реплик"""
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+class ShardRouter:
+    """
+    Шардирование заказов по client_id.
+
+    Заказы клиента и их позиции хранятся в шарде client_id % N.
+    Справочники (категории, товары, клиенты) копируются из шарда 0
+    во все шарды (replicate_reference_data), поэтому проверка товара
+    и join с клиентом выполняются внутри шарда заказа. Справочники
+    изменяются только в шарде 0; приложение копирует их при старте
+    и затем каждые SHARD_REFERENCE_SYNC_SECONDS, вручную — скрипт
+    scripts/replicate_reference_data.py.
+
+    Шард заказа определяется по его ID:
+    - modulo: ID выдаются последовательностями шардов
+      (START WITH shard + 1 INCREMENT BY N), шард = (order_id - 1) % N;
+    - lookup: ID произвольные, шард ищется опросом всех шардов
+      и запоминается в LRU-кэше.
+    """
+
+    def __init__(self, shard_urls: List[str], id_scheme: str = "modulo",
+                 lookup_cache_size: int = 100_000, echo: bool = False,
+                 engine_options: Optional[Dict] = None):
+        self.engines = [_create_engine(url, echo=echo, **(engine_options or {})) for url in shard_urls]
+        self.session_factories = [
+            sessionmaker(autocommit=False, autoflush=False, bind=engine) for engine in self.engines
+        ]
+        self._id_scheme = id_scheme
+        self._lookup_cache_size = lookup_cache_size
+        self._order_shards: "OrderedDict[int, int]" = OrderedDict()
+        self._reference_watermark: Optional[datetime] = None
+
+    @property
+    def shard_count(self) -> int:
+        return len(self.engines)
+
+    def shard_for_client(self, client_id: int) -> int:
+        return client_id % self.shard_count
+
+    def shard_for_order(self, order_id: int) -> Optional[int]:
+        """Шард заказа или None, если заказ не найден (только для lookup)"""
+        if self._id_scheme == "modulo":
+            return (order_id - 1) % self.shard_count
+
+        shard = self._order_shards.get(order_id)
+        if shard is not None:
+            self._order_shards.move_to_end(order_id)
+            return shard
+
+        for shard, session_factory in enumerate(self.session_factories):
+            db = session_factory()
+            try:
+                found = db.query(Order.id).filter(Order.id == order_id).first()
+            finally:
+                db.close()
+            if found:
+                self.remember_order(order_id, shard)
+                return shard
+        return None
+
+    def remember_order(self, order_id: int, shard: int) -> None:
+        self._order_shards[order_id] = shard
+        self._order_shards.move_to_end(order_id)
+        while len(self._order_shards) > self._lookup_cache_size:
+            self._order_shards.popitem(last=False)
+
+    def session(self, shard: int) -> Session:
+        return self.session_factories[shard]()
+
+    def replicate_reference_data(self, incremental: bool = False) -> Dict[str, int]:
+        """
+        Копирует категории, товары и клиентов из шарда 0 во все остальные
+        (вставка или обновление по ID). Удаления не переносятся.
+
+        incremental=True копирует только строки, измененные с прошлой
+        синхронизации (по updated_at); первый вызов всегда полный.
+        Возвращает число скопированных строк по таблицам.
+        """
+        since = self._reference_watermark if incremental else None
+        source = self.session(0)
+        try:
+            def changed(model):
+                query = source.query(model)
+                if since is not None:
+                    query = query.filter(model.updated_at >= since)
+                return query
+
+            categories = changed(Category).all()
+            # Родительские категории вставляются раньше дочерних
+            by_parent: Dict[Optional[int], List[Category]] = {}
+            for category in categories:
+                by_parent.setdefault(category.parent_id, []).append(category)
+            # Корни — категории, родитель которых не изменился (уже есть в шардах)
+            changed_ids = {category.id for category in categories}
+            ordered = []
+            level = [category for category in categories if category.parent_id not in changed_ids]
+            while level:
+                ordered += level
+                level = [child for category in level for child in by_parent.get(category.id, [])]
+
+            reference = [
+                (Category, ordered),
+                (Nomenclature, changed(Nomenclature).order_by(Nomenclature.id).all()),
+                (Client, changed(Client).order_by(Client.id).all())
+            ]
+            for shard in range(1, self.shard_count):
+                target = self.session(shard)
+                try:
+                    for model, rows in reference:
+                        for row in rows:
+                            target.merge(model(**{
+                                column.key: getattr(row, column.key) for column in model.__table__.columns
+                            }))
+                        target.flush()
+                    target.commit()
+                except Exception:
+                    target.rollback()
+                    raise
+                finally:
+                    target.close()
+        finally:
+            source.close()
+
+        # Граница включительная: строки, измененные в ту же секунду, скопируются повторно
+        updated = [row.updated_at for _, rows in reference for row in rows if row.updated_at is not None]
+        if updated:
+            self._reference_watermark = max(updated + [since or datetime.min])
+        return {model.__tablename__: len(rows) for model, rows in reference}
+
+    def dispose(self) -> None:
+        for engine in self.engines:
+            engine.dispose()
+
+class Database:
+    """
+    Пулы соединений приложения: primary и реплики.
+    Создается при старте приложения (см. create_app), а не при импорте модуля:
+    создание engine подгружает драйвер БД.
+    
+    Если заданы SHARD_DATABASE_URLS, primary — шард 0 (источник
+    справочников), а сессии заказов выдает ShardRouter.
+    """
+
+    def __init__(self, app_settings: Settings):
+        engine_options = {
+            "prepare_threshold": app_settings.DB_PREPARE_THRESHOLD,
+            "query_cache_size": app_settings.DB_QUERY_CACHE_SIZE
+        }
+        self.shard_router = None
+        if app_settings.shard_database_urls:
+            self.shard_router = ShardRouter(
+                app_settings.shard_database_urls,
+                id_scheme=app_settings.SHARD_ID_SCHEME,
+                lookup_cache_size=app_settings.SHARD_LOOKUP_CACHE_SIZE,
+                echo=app_settings.DEBUG,
+                engine_options=engine_options
+            )
+            self.engine = self.shard_router.engines[0]
+        else:
+            self.engine = _create_engine(app_settings.database_url, echo=app_settings.DEBUG, **engine_options)
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.replica_router = ReplicaRouter(
+            app_settings.replica_database_urls,
+            strategy=app_settings.REPLICA_STRATEGY,
+            pin_seconds=app_settings.REPLICA_PIN_SECONDS,
+            max_lag_seconds=app_settings.REPLICA_MAX_LAG_SECONDS,
+            lag_check_interval=app_settings.REPLICA_LAG_CHECK_INTERVAL,
+            echo=app_settings.DEBUG,
+            engine_options=engine_options
+        )
+
+    def ping(self) -> None:
+        """Открывает первое соединение пула primary"""
+        with self.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+
+    @property
+    def order_session_factories(self) -> List[sessionmaker]:
+        """Фабрики сессий всех баз с заказами: шардов или одного primary"""
+        if self.shard_router is not None:
+            return self.shard_router.session_factories
+        return [self.SessionLocal]
+
+    def session_for_order(self, order_id: Optional[int] = None) -> Session:
+        """Сессия шарда заказа; без шардирования или без заказа — сессия primary"""
+        if self.shard_router is not None and order_id is not None:
+            shard = self.shard_router.shard_for_order(order_id)
+            if shard is not None:
+                return self.shard_router.session(shard)
+        return self.SessionLocal()
+
+    def dispose(self) -> None:
+        """Закрывает все пулы соединений"""
+        self.engine.dispose()
+        self.replica_router.dispose()
+        if self.shard_router is not None:
+            self.shard_router.dispose()
+
+def get_database(request: Request) -> Database:
+    return request.app.state.resources.database
+
+def _path_order_id(request: Request) -> Optional[int]:
+    try:
+        return int(request.path_params["order_id"])
+    except (KeyError, ValueError):
+        return None
+
+def get_db(request: Request, database: Database = Depends(get_database)):
+    """Сессия primary или, при шардировании, шарда заказа из пути запроса"""
+    db = database.session_for_order(_path_order_id(request))
     try:
         yield db
     finally:
         db.close()
+
+def get_read_db(request: Request, db: Session = Depends(get_db), database: Database = Depends(get_database)):
+    """
+    Сессия для read-only эндпоинтов: реплика, если она подходит,
+    иначе сессия primary. Чтения заказа, в который недавно писали,
+    закрепляются за primary (см. ReplicaRouter).
+    """
+    if database.shard_router is not None:
+        # Реплики настраиваются для одного primary и с шардами не используются
+        yield db
+        return
+    
+    order_id = _path_order_id(request)
+    pin_key = ("order", order_id) if order_id is not None else None
+    
+    replica_db = database.replica_router.read_session(pin_key)
+    if replica_db is None:
+        yield db
+        return
+    
+    try:
+        yield replica_db
+    finally:
+        replica_db.close()
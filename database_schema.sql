@@ -27,6 +27,10 @@ CREATE INDEX idx_nomenclature_category_id ON nomenclature(category_id);
 CREATE INDEX idx_nomenclature_name ON nomenclature(name);
 CREATE INDEX idx_nomenclature_quantity ON nomenclature(quantity);
 
+-- Поиск по подстроке названия (GET /nomenclature/search)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX idx_nomenclature_name_trgm ON nomenclature USING gin (lower(name) gin_trgm_ops);
+
 CREATE TABLE clients (
     id SERIAL PRIMARY KEY,
     name VARCHAR(255) NOT NULL,
@@ -43,6 +47,7 @@ CREATE TABLE orders (
     order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     status VARCHAR(50) DEFAULT 'pending',
     total_amount DECIMAL(10, 2) DEFAULT 0.00,
+    version INTEGER NOT NULL DEFAULT 1,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE RESTRICT
@@ -52,6 +57,10 @@ CREATE INDEX idx_orders_client_id ON orders(client_id);
 CREATE INDEX idx_orders_date ON orders(order_date);
 CREATE INDEX idx_orders_status ON orders(status);
 
+-- При шардировании (SHARD_DATABASE_URLS, SHARD_ID_SCHEME=modulo) в шарде k из N
+-- ID заказов выдаются так, чтобы (id - 1) % N = k:
+-- ALTER SEQUENCE orders_id_seq INCREMENT BY <N> RESTART WITH <k + 1>;
+
 CREATE TABLE order_items (
     id SERIAL PRIMARY KEY,
     order_id INTEGER NOT NULL,
@@ -64,8 +73,18 @@ CREATE TABLE order_items (
 );
 
 CREATE INDEX idx_order_items_order_id ON order_items(order_id);
+CREATE UNIQUE INDEX uq_order_items_order_nomenclature ON order_items(order_id, nomenclature_id);
 CREATE INDEX idx_order_items_nomenclature_id ON order_items(nomenclature_id);
 
+CREATE TABLE idempotency_keys (
+    key VARCHAR(255) PRIMARY KEY,
+    fingerprint VARCHAR(64) NOT NULL,
+    response TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_idempotency_keys_created_at ON idempotency_keys(created_at);
+
 -- Триггер для обновления updated_at
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
@@ -0,0 +1,134 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import logging
+
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class _PendingWrite:
+    db: Session
+    args: Tuple[Any, ...]
+    future: asyncio.Future
+
+class GroupCommitWriter:
+    """
+    Group commit: записи из разных запросов копятся в очереди, и задача-писатель
+    применяет их пачками (до max_batch_size штук или каждые interval_ms)
+    в одной транзакции — один commit и один сброс WAL на пачку.
+
+    Каждая запись выполняется в своем SAVEPOINT, поэтому ошибка одного
+    запроса откатывает только его изменения. Очередь обрабатывается строго
+    по порядку, так что записи в один заказ применяются в порядке поступления.
+    Пачка выполняется в сессии первого запроса: ее владелец ждет результата,
+    пока пачка не будет зафиксирована. При шардировании пачка делится
+    по базам сессий, и каждая часть фиксируется в своем шарде.
+    """
+
+    def __init__(self, apply_fn: Callable[..., Any], max_batch_size: int = 100, interval_ms: float = 5.0,
+                 on_batch: Optional[Callable[[int], None]] = None):
+        self._apply_fn = apply_fn
+        self._on_batch = on_batch
+        self._max_batch_size = max_batch_size
+        self._interval = interval_ms / 1000
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def submit(self, db: Session, *args) -> Any:
+        """Ставит запись в очередь и ждет ее результата после commit пачки"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = None
+
+        future = loop.create_future()
+        self._queue.put_nowait(_PendingWrite(db=db, args=args, future=future))
+
+        # Писатель живет, пока в очереди есть записи, и завершается при простое
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+        return await asyncio.shield(future)
+
+    async def _run(self) -> None:
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait()]
+            deadline = self._loop.time() + self._interval
+
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Записи в разные шарды фиксируются раздельно, порядок внутри шарда сохраняется
+            by_bind: Dict[Any, List[_PendingWrite]] = {}
+            try:
+                for write in batch:
+                    by_bind.setdefault(write.db.get_bind(), []).append(write)
+            except Exception as e:
+                self._fail(batch, e)
+                continue
+            for shard_batch in by_bind.values():
+                # Ошибка одной пачки не останавливает писателя: остальные пачки и очередь обрабатываются
+                try:
+                    self._apply_batch(shard_batch)
+                except Exception as e:
+                    logger.error(f"Group commit writer error: {str(e)}")
+                    self._fail(shard_batch, e)
+
+    def _apply_batch(self, batch: List[_PendingWrite]) -> None:
+        db = batch[0].db
+        outcomes: List[Tuple[_PendingWrite, Any, Optional[BaseException]]] = []
+
+        try:
+            try:
+                for write in batch:
+                    savepoint = db.begin_nested()
+                    try:
+                        result = self._apply_fn(db, *write.args)
+                        savepoint.commit()
+                        outcomes.append((write, result, None))
+                    except Exception as e:
+                        savepoint.rollback()
+                        outcomes.append((write, None, e))
+
+                db.commit()
+            except Exception as e:
+                logger.error(f"Group commit failed for batch of {len(batch)}: {str(e)}")
+                try:
+                    db.rollback()
+                except Exception as rollback_error:
+                    logger.error(f"Group commit rollback failed: {str(rollback_error)}")
+                # Транзакция не зафиксирована: ошибку получают все запросы пачки
+                outcomes = [(write, None, write_error or e) for write, _, write_error in outcomes]
+                outcomes += [(write, None, e) for write in batch[len(outcomes):]]
+
+            if self._on_batch is not None:
+                try:
+                    self._on_batch(len(batch))
+                except Exception as e:
+                    logger.error(f"Group commit on_batch callback failed: {str(e)}")
+            logger.debug(f"Group commit applied batch of {len(batch)}")
+        finally:
+            # Каждый запрос пачки получает результат или ошибку, что бы ни случилось выше
+            for write, result, error in outcomes:
+                if write.future.done():
+                    continue
+                if error is not None:
+                    write.future.set_exception(error)
+                else:
+                    write.future.set_result(result)
+            self._fail(batch, RuntimeError("Group commit batch was not applied"))
+
+    def _fail(self, batch: List[_PendingWrite], error: BaseException) -> None:
+        for write in batch:
+            if not write.future.done():
+                write.future.set_exception(error)
@@ -0,0 +1,31 @@
+from datetime import datetime
+from typing import Optional
+
+def make_etag(kind: str, entity_id: int, *versions: Optional[datetime], revision: Optional[int] = None) -> str:
+    """
+    Строит сильный ETag из идентификатора сущности и updated_at.
+    Версией считается самый поздний updated_at среди переданных записей
+    (сама сущность и связанные с ней данные, попадающие в ответ).
+    revision — номер версии сущности (orders.version), если он ведется.
+    """
+    known = [version for version in versions if version is not None]
+    version = int(max(known).timestamp() * 1_000_000) if known else 0
+    if revision is not None:
+        return f'"{kind}-{entity_id}-r{revision}-{version}"'
+    return f'"{kind}-{entity_id}-{version}"'
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Проверяет заголовок If-None-Match (список ETag или '*')"""
+    if not if_none_match or not etag:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        # Для If-None-Match используется слабое сравнение
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
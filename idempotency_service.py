@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Dict, NamedTuple, Optional, Tuple
+import logging
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+
+class IdempotencyReplayError(Exception):
+    """Ключ уже записан другой транзакцией: запрос нужно ответить сохраненным ответом"""
+
+def make_fingerprint(*parts) -> str:
+    """Отпечаток запроса: sha256 от канонического JSON его частей"""
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class IdempotencyClaim(NamedTuple):
+    """Ключ запроса, который нужно записать вместе с изменением"""
+    key: str
+    fingerprint: str
+    ttl_seconds: int
+
+def _expired_before(ttl_seconds: int) -> datetime:
+    return datetime.utcnow() - timedelta(seconds=ttl_seconds)
+
+def reserve_key(db: Session, claim: IdempotencyClaim, response_json: str) -> None:
+    """
+    Записывает ключ с ответом в текущей транзакции. Запись фиксируется тем же
+    commit, что и изменение заказа, поэтому повтор после сбоя не применит
+    изменение второй раз. Если ключ уже записан и не истек, выбрасывает
+    IdempotencyReplayError; истекшая запись заменяется новой.
+    """
+    for _ in range(2):
+        savepoint = db.begin_nested()
+        try:
+            db.add(IdempotencyKey(key=claim.key, fingerprint=claim.fingerprint, response=response_json))
+            db.flush()
+            savepoint.commit()
+            return
+        except IntegrityError:
+            savepoint.rollback()
+        
+        expired = db.query(IdempotencyKey).filter(
+            IdempotencyKey.key == claim.key,
+            IdempotencyKey.created_at < _expired_before(claim.ttl_seconds)
+        ).delete(synchronize_session=False)
+        if not expired:
+            break
+    raise IdempotencyReplayError(claim.key)
+
+def purge_expired_keys(db: Session, ttl_seconds: int, batch_size: int = 1000) -> int:
+    """Удаляет истекшие ключи пачками (по idx_idempotency_keys_created_at); возвращает их число"""
+    cutoff = _expired_before(ttl_seconds)
+    purged = 0
+    while True:
+        keys = [row.key for row in db.query(IdempotencyKey.key).filter(
+            IdempotencyKey.created_at < cutoff
+        ).order_by(IdempotencyKey.created_at).limit(batch_size).all()]
+        if not keys:
+            return purged
+        db.query(IdempotencyKey).filter(IdempotencyKey.key.in_(keys)).delete(synchronize_session=False)
+        db.commit()
+        purged += len(keys)
+
+class IdempotencyService:
+    """
+    Хранилище ответов по Idempotency-Key.
+
+    Ответы ищутся по порядку: в памяти процесса (LRU с TTL), в общем
+    хранилище (Redis, если IDEMPOTENCY_BACKEND=redis) и в таблице
+    idempotency_keys, которая является источником истины. Параллельные
+    запросы с одним ключом в процессе ждут первого через guard().
+    """
+
+    def __init__(self, ttl_seconds: int = 86400, max_entries: int = 100000,
+                 backend: str = "memory", redis_url: Optional[str] = None):
+        self.ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+        self._backend = backend
+        self._redis_url = redis_url
+        self._redis = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    @asynccontextmanager
+    async def guard(self, key: str):
+        """Выполняет блок, пока другие запросы с тем же ключом ждут его завершения"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._in_flight = {}
+
+        while key in self._in_flight:
+            try:
+                await asyncio.shield(self._in_flight[key])
+            except Exception:
+                pass
+
+        future = loop.create_future()
+        self._in_flight[key] = future
+        try:
+            yield
+        finally:
+            del self._in_flight[key]
+            future.set_result(None)
+
+    async def lookup(self, db: Session, key: str) -> Optional[Tuple[str, str]]:
+        """Возвращает (fingerprint, response_json) ранее выполненного запроса или None"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[2] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[0], entry[1]
+            del self._entries[key]
+
+        stored = await self._shared_get(key)
+        if stored is None:
+            # Запрос к таблице выполняется в пуле потоков, не блокируя цикл событий
+            stored = await asyncio.to_thread(self._table_get, db, key)
+            if stored is None:
+                return None
+
+        self._remember_local(key, *stored)
+        return stored
+
+    async def remember(self, key: str, fingerprint: str, response_json: str) -> None:
+        """Кладет ответ в память процесса и в общее хранилище после commit"""
+        self._remember_local(key, fingerprint, response_json)
+        await self._shared_set(key, fingerprint, response_json)
+
+    def _table_get(self, db: Session, key: str) -> Optional[Tuple[str, str]]:
+        row = db.query(IdempotencyKey).filter(
+            IdempotencyKey.key == key,
+            IdempotencyKey.created_at >= _expired_before(self.ttl_seconds)
+        ).first()
+        if row is None or row.response is None:
+            return None
+        return row.fingerprint, row.response
+
+    def claim(self, key: str, fingerprint: str) -> IdempotencyClaim:
+        return IdempotencyClaim(key, fingerprint, self.ttl_seconds)
+
+    def _remember_local(self, key: str, fingerprint: str, response_json: str) -> None:
+        self._entries[key] = (fingerprint, response_json, time.monotonic() + self.ttl_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_redis(self):
+        if self._backend != "redis":
+            return None
+        if self._redis is None:
+            import redis.asyncio as aioredis
+
+            self._redis = aioredis.from_url(self._redis_url)
+        return self._redis
+
+    async def _shared_get(self, key: str) -> Optional[Tuple[str, str]]:
+        try:
+            client = self._get_redis()
+            if client is None:
+                return None
+            raw = await client.get(f"idempotency:{key}")
+        except Exception as e:
+            # Общее хранилище — только ускорение: при ошибке идем в БД
+            logger.error(f"Ошибка чтения ключа идемпотентности из Redis: {str(e)}")
+            return None
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return data["fingerprint"], data["response"]
+
+    async def _shared_set(self, key: str, fingerprint: str, response_json: str) -> None:
+        try:
+            client = self._get_redis()
+            if client is None:
+                return
+            payload = json.dumps({"fingerprint": fingerprint, "response": response_json})
+            await client.set(f"idempotency:{key}", payload, ex=self.ttl_seconds)
+        except Exception as e:
+            logger.error(f"Ошибка записи ключа идемпотентности в Redis: {str(e)}")
@@ -1,57 +1,99 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Request, Response, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
 from decimal import Decimal
-from typing import Union
+from typing import Union, Optional, Any, Callable, Dict, List
+from contextlib import asynccontextmanager, nullcontext
+from functools import partial, wraps
+import asyncio
+import hmac
 import logging
 import traceback
 import time
 
-from database import get_db, Order, OrderItem, Nomenclature, Client, Category
+from database import Database, get_database, get_db, get_read_db, OrderItem, Client
 from models import (
     AddItemToOrderRequest, 
     AddItemToOrderResponse, 
     ErrorResponse,
     OrderInfo,
-    OrderItemInfo,
-    NomenclatureInfo
-)
-from cache_service import cache_service
-from metrics_service import metrics_service
-from config import settings
-
-# Запускам логгер
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    NomenclatureInfo,
+    NomenclatureSearchResponse,
+    ClientOrderTotal
 )
+from resources import AppResources, get_resources
+from idempotency_service import IdempotencyClaim, IdempotencyReplayError, MAX_KEY_LENGTH, make_fingerprint, reserve_key
+from http_cache import etag_matches
+from batch_loader import BatchLoader
+from group_commit import GroupCommitWriter
+from admission_control import AdmissionController, AdmissionRejected
+from search_service import normalize_query
+from timing_service import timing_service
+from config import Settings, settings
+import repository
+import statements
+
 logger = logging.getLogger(__name__)
 
-app = FastAPI(
-    title="Test Task API",
-    version="1.0.0",
-    description="API для управления заказами"
-)
+def configure_logging(app_settings: Settings) -> None:
+    """Запускает логгер"""
+    logging.basicConfig(
+        level=app_settings.LOG_LEVEL,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+class TimedRoute(APIRoute):
+    """
+    Маршрут, учитывающий в фазе serialize все, что FastAPI делает после
+    возврата из эндпоинта: валидацию response_model, jsonable_encoder
+    и JSON-кодирование.
+    """
+    
+    def get_route_handler(self) -> Callable:
+        endpoint = self.dependant.call
+        if asyncio.iscoroutinefunction(endpoint):
+            @wraps(endpoint)
+            async def timed_endpoint(*args, **kwargs):
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    timing_service.mark_endpoint_done()
+        else:
+            @wraps(endpoint)
+            def timed_endpoint(*args, **kwargs):
+                try:
+                    return endpoint(*args, **kwargs)
+                finally:
+                    timing_service.mark_endpoint_done()
+        self.dependant.call = timed_endpoint
+        
+        handler = super().get_route_handler()
+        
+        async def timed_handler(request: Request) -> Response:
+            with timing_service.serialize_after_endpoint():
+                return await handler(request)
+        
+        return timed_handler
+
+router = APIRouter(route_class=TimedRoute)
 
 # Middleware для логирования запросов и метрик
-@app.middleware("http")
 async def log_requests_and_metrics(request: Request, call_next):
+    resources: AppResources = request.app.state.resources
     start_time = time.time()
+    phases = timing_service.start_request()
     
     response = await call_next(request)
     
     process_time = time.time() - start_time
     
+    # Разбивка времени по фазам (cache, db, serialize)
+    if resources.settings.SERVER_TIMING_ENABLED:
+        response.headers["Server-Timing"] = timing_service.format_server_timing(phases, process_time)
+    
     # Логирование
     logger.info(
         f"{request.method} {request.url.path} - "
@@ -60,29 +102,45 @@ async def log_requests_and_metrics(request: Request, call_next):
     )
     
     # Метрики
-    metrics_service.record_request(
+    resources.metrics.record_request(
         method=request.method,
         endpoint=request.url.path,
         status_code=response.status_code,
         duration=process_time
     )
+    # Метка — шаблон маршрута, а не путь: иначе по серии на каждый ID заказа и товара
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    for phase, duration in phases.items():
+        resources.metrics.record_request_phase(endpoint, phase, duration)
     
     return response
 
-@app.get("/")
+@router.get("/")
 async def root():
     return {"message": "API работает"}
 
-@app.get("/health")
+@router.get("/health")
 async def health():
     """Базовый health check"""
     return {"status": "ok"}
 
-@app.get("/health/detailed")
-async def health_detailed():
+@router.get("/health/ready")
+async def health_ready(
+    resources: AppResources = Depends(get_resources)
+):
+    """Readiness probe: сервис готов после прогрева кэша"""
+    if not resources.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready"}
+
+@router.get("/health/detailed")
+async def health_detailed(
+    resources: AppResources = Depends(get_resources)
+):
     """Детальный health check с метриками"""
-    health_status = metrics_service.get_health_status()
-    cache_stats = cache_service.get_cache_stats()
+    health_status = resources.metrics.get_health_status()
+    cache_stats = resources.cache.get_cache_stats()
     
     return {
         **health_status,
@@ -90,117 +148,294 @@ async def health_detailed():
         "version": "1.0.0"
     }
 
-@app.get("/metrics")
-async def metrics():
+@router.get("/metrics")
+async def metrics(
+    resources: AppResources = Depends(get_resources)
+):
     """Prometheus метрики"""
     return Response(
-        content=metrics_service.get_metrics(),
+        content=resources.metrics.get_metrics(),
         media_type="text/plain"
     )
 
-@app.get("/cache/stats")
-async def cache_stats():
+@router.get("/cache/stats")
+async def cache_stats(
+    resources: AppResources = Depends(get_resources)
+):
     """Статистика кэша"""
-    return cache_service.get_cache_stats()
+    return resources.cache.get_cache_stats()
 
-@app.post("/cache/clear")
-async def clear_cache():
+@router.post("/cache/clear")
+async def clear_cache(
+    resources: AppResources = Depends(get_resources)
+):
     """Очистка кэша"""
-    cache_service._cache.clear()
+    resources.cache.clear()
     logger.info("Cache cleared manually")
     return {"message": "Cache cleared successfully"}
 
-@app.post("/orders/{order_id}/items", response_model=AddItemToOrderResponse)
+def _require_admin(token: Optional[str], app_settings: Settings) -> None:
+    """Проверяет admin-токен; без настроенного ADMIN_TOKEN доступ закрыт"""
+    admin_token = app_settings.ADMIN_TOKEN
+    if not admin_token or not token or not hmac.compare_digest(token, admin_token):
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+@router.get("/admin/profile")
+async def profile(
+    seconds: float = Query(5.0, gt=0, description="Длительность профилирования, с"),
+    interval_ms: float = Query(5.0, ge=1, le=1000, description="Интервал выборки, мс"),
+    x_admin_token: Optional[str] = Header(None),
+    resources: AppResources = Depends(get_resources)
+):
+    """
+    Профилирует текущий воркер в течение seconds секунд.
+    Возвращает стеки в collapsed-формате для flamegraph.pl/speedscope.
+    """
+    _require_admin(x_admin_token, resources.settings)
+    max_seconds = resources.settings.PROFILER_MAX_SECONDS
+    if seconds > max_seconds:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Максимальная длительность профилирования: {max_seconds}с"
+        )
+    
+    from profiler_service import profiler_service, ProfilerBusyError
+    
+    try:
+        profiler_service.start(interval=interval_ms / 1000)
+    except ProfilerBusyError:
+        raise HTTPException(status_code=409, detail="Профилирование уже выполняется")
+    
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        collapsed = profiler_service.stop()
+    
+    return Response(content=collapsed, media_type="text/plain")
+
+def _add_item_once(db: Session, order_id: int, request: AddItemToOrderRequest) -> AddItemToOrderResponse:
+    """Одна попытка добавления товара к заказу в текущей транзакции"""
+    # Проверяем существование заказа (строку заказа в сессию не загружаем)
+    if not statements.order_exists(db, order_id):
+        logger.warning(f"Заказ {order_id} не найден")
+        raise HTTPException(status_code=404, detail=f"Заказ {order_id} не найден")
+    
+    # Проверяем существование товара
+    nomenclature = statements.nomenclature_stock(db, request.nomenclature_id)
+    if not nomenclature:
+        logger.warning(f"Товар {request.nomenclature_id} не найден")
+        raise HTTPException(status_code=404, detail=f"Товар {request.nomenclature_id} не найден")
+    
+    # Проверяем наличие товара на складе
+    if nomenclature.quantity < request.quantity:
+        logger.warning(f"Недостаточно товара {request.nomenclature_id}. Доступно: {nomenclature.quantity}, запрошено: {request.quantity}")
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Недостаточно товара на складе. Доступно: {nomenclature.quantity}, запрошено: {request.quantity}"
+        )
+    
+    # Увеличиваем количество существующей позиции атомарно на стороне БД
+    existing_item = statements.increment_order_item(
+        db, order_id, request.nomenclature_id, request.quantity, nomenclature.price
+    )
+    
+    if not existing_item:
+        # Создаем новую позицию в заказе; параллельная вставка той же позиции
+        # нарушит uq_order_items_order_nomenclature, и попытка будет повторена
+        new_item = OrderItem(
+            order_id=order_id,
+            nomenclature_id=request.nomenclature_id,
+            quantity=request.quantity,
+            price=nomenclature.price
+        )
+        db.add(new_item)
+        db.flush()
+    
+    # Сумма заказа увеличивается инкрементом в SQL, без read-modify-write в Python
+    statements.increment_order_total(db, order_id, nomenclature.price * request.quantity)
+    
+    if existing_item:
+        logger.info(f"Увеличено количество товара {request.nomenclature_id} в заказе {order_id}")
+        return AddItemToOrderResponse(
+            success=True,
+            message=f"Количество товара '{nomenclature.name}' увеличено",
+            order_item_id=existing_item.id,
+            total_quantity=existing_item.quantity
+        )
+    
+    logger.info(f"Добавлен новый товар {request.nomenclature_id} в заказ {order_id}")
+    return AddItemToOrderResponse(
+        success=True,
+        message=f"Товар '{nomenclature.name}' добавлен в заказ",
+        order_item_id=new_item.id,
+        total_quantity=new_item.quantity
+    )
+
+def _apply_add_item(
+    db: Session,
+    order_id: int,
+    request: AddItemToOrderRequest,
+    max_retries: int,
+    idempotency: Optional[IdempotencyClaim] = None
+) -> AddItemToOrderResponse:
+    """
+    Применяет добавление товара к заказу в текущей транзакции (без commit).
+    Бизнес-ошибки выбрасываются как HTTPException.
+    
+    Каждая попытка выполняется в SAVEPOINT. Заказ меняется только
+    атомарными UPDATE, поэтому повтор нужен лишь при гонке вставки одной
+    позиции (нарушение uq_order_items_order_nomenclature): попытка
+    откатывается и повторяется уже как увеличение количества.
+    max_retries — число попыток (ORDER_WRITE_MAX_RETRIES экземпляра
+    приложения), не меньше одной.
+    idempotency (IdempotencyClaim) записывает ключ с ответом в той же
+    транзакции; если ключ уже записан, изменение откатывается
+    с IdempotencyReplayError.
+    """
+    max_retries = max(max_retries, 1)
+    for attempt in range(1, max_retries + 1):
+        savepoint = db.begin_nested()
+        try:
+            result = _add_item_once(db, order_id, request)
+            if idempotency is not None:
+                reserve_key(db, idempotency, result.model_dump_json())
+            savepoint.commit()
+            return result
+        except IntegrityError as e:
+            savepoint.rollback()
+            if attempt == max_retries:
+                raise
+            logger.info(f"Гонка вставки позиции в заказ {order_id}, повтор {attempt}: {type(e).__name__}")
+        except Exception:
+            savepoint.rollback()
+            raise
+
+def _replay_add_item(response: Response, stored: tuple, fingerprint: str) -> AddItemToOrderResponse:
+    """Возвращает сохраненный ответ повторного запроса с тем же Idempotency-Key"""
+    stored_fingerprint, response_json = stored
+    if stored_fingerprint != fingerprint:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency-Key уже использован с другим телом запроса"
+        )
+    response.headers["Idempotent-Replayed"] = "true"
+    return AddItemToOrderResponse.model_validate_json(response_json)
+
+def _add_item_slot(resources: AppResources, deadline: float):
+    """
+    Слот admission control на запись в заказ. В режиме group commit слот не
+    берется: записи и так идут через одну очередь писателя, а лимит слотов
+    ограничил бы размер пачки.
+    """
+    if resources.settings.ADD_ITEM_WRITE_MODE == "group":
+        return nullcontext()
+    return resources.admission.slot("add_item_to_order", deadline)
+
+def _commit_add_item(
+    db: Session,
+    order_id: int,
+    request: AddItemToOrderRequest,
+    resources: AppResources,
+    idempotency: Optional[IdempotencyClaim] = None
+) -> AddItemToOrderResponse:
+    """Применяет добавление и фиксирует транзакцию (выполняется в пуле потоков)"""
+    result = _apply_add_item(db, order_id, request, resources.settings.ORDER_WRITE_MAX_RETRIES, idempotency)
+    db.commit()
+    # Чтения этого заказа закрепляются за primary, пока реплики не догонят запись
+    resources.database.replica_router.mark_written(("order", order_id), db)
+    return result
+
+async def _write_add_item(
+    db: Session,
+    order_id: int,
+    request: AddItemToOrderRequest,
+    resources: AppResources,
+    idempotency: Optional[IdempotencyClaim] = None
+) -> AddItemToOrderResponse:
+    """
+    Записывает добавление товара. В режиме direct работа с БД идет в пуле
+    потоков: пока она выполняется, слот admission control занят, а цикл
+    событий принимает и при перегрузке отклоняет другие запросы.
+    """
+    with timing_service.phase("db"):
+        if resources.settings.ADD_ITEM_WRITE_MODE == "group":
+            result = await resources.add_item_writer.submit(
+                db, order_id, request, resources.settings.ORDER_WRITE_MAX_RETRIES, idempotency
+            )
+            await asyncio.to_thread(resources.database.replica_router.mark_written, ("order", order_id), db)
+        else:
+            result = await asyncio.to_thread(_commit_add_item, db, order_id, request, resources, idempotency)
+    
+    # Инвалидируем кэш после изменений
+    await resources.cache.delete_pattern(f"order_full:order_id:{order_id}")
+    
+    # Записываем метрики
+    resources.metrics.record_database_query("update", "orders")
+    resources.metrics.record_database_query("insert", "order_items")
+    
+    return result
+
+@router.post("/orders/{order_id}/items", response_model=AddItemToOrderResponse)
 async def add_item_to_order(
     order_id: int,
     request: AddItemToOrderRequest,
-    db: Session = Depends(get_db)
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    x_request_timeout_ms: Optional[int] = Header(None),
+    db: Session = Depends(get_db),
+    resources: AppResources = Depends(get_resources)
 ):
     """
     Добавляет товар в заказ.
     Если товар уже есть в заказе, увеличивает его количество.
+    
+    С заголовком Idempotency-Key повтор запроса возвращает сохраненный
+    ответ (с заголовком Idempotent-Replayed: true) и не меняет заказ повторно.
+    X-Request-Timeout-Ms задает бюджет клиента: если слот к БД не освободится
+    за это время, запрос сразу получает 503 с Retry-After.
     """
     try:
         logger.info(f"Добавление товара {request.nomenclature_id} в заказ {order_id}, количество: {request.quantity}")
+        deadline = resources.admission.deadline(x_request_timeout_ms)
         
-        # Проверяем существование заказа
-        order = db.query(Order).filter(Order.id == order_id).first()
-        if not order:
-            logger.warning(f"Заказ {order_id} не найден")
-            raise HTTPException(status_code=404, detail=f"Заказ {order_id} не найден")
+        if idempotency_key is None:
+            async with _add_item_slot(resources, deadline):
+                return await _write_add_item(db, order_id, request, resources)
         
-        # Проверяем существование товара
-        nomenclature = db.query(Nomenclature).filter(
-            Nomenclature.id == request.nomenclature_id
-        ).first()
-        if not nomenclature:
-            logger.warning(f"Товар {request.nomenclature_id} не найден")
-            raise HTTPException(status_code=404, detail=f"Товар {request.nomenclature_id} не найден")
-        
-        # Проверяем наличие товара на складе
-        if nomenclature.quantity < request.quantity:
-            logger.warning(f"Недостаточно товара {request.nomenclature_id}. Доступно: {nomenclature.quantity}, запрошено: {request.quantity}")
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
             raise HTTPException(
-                status_code=400, 
-                detail=f"Недостаточно товара на складе. Доступно: {nomenclature.quantity}, запрошено: {request.quantity}"
-            )
-        
-        # Проверяем, есть ли уже такой товар в заказе
-        existing_item = db.query(OrderItem).filter(
-            and_(
-                OrderItem.order_id == order_id,
-                OrderItem.nomenclature_id == request.nomenclature_id
+                status_code=400,
+                detail=f"Idempotency-Key должен содержать от 1 до {MAX_KEY_LENGTH} символов"
             )
-        ).first()
         
-        if existing_item:
-            # Увеличиваем количество существующего товара
-            existing_item.quantity += request.quantity
-            existing_item.price = nomenclature.price
-            order.total_amount += nomenclature.price * request.quantity
-            
-            logger.info(f"Увеличено количество товара {request.nomenclature_id} в заказе {order_id}")
-        else:
-            # Создаем новую позицию в заказе
-            new_item = OrderItem(
-                order_id=order_id,
-                nomenclature_id=request.nomenclature_id,
-                quantity=request.quantity,
-                price=nomenclature.price
-            )
-            
-            db.add(new_item)
-            order.total_amount += nomenclature.price * request.quantity
+        fingerprint = make_fingerprint(order_id, request.model_dump())
+        async with resources.idempotency.guard(idempotency_key):
+            # Поиск ключа в таблице тоже занимает соединение, поэтому идет внутри слота
+            async with _add_item_slot(resources, deadline):
+                stored = await resources.idempotency.lookup(db, idempotency_key)
+                if stored is not None:
+                    return _replay_add_item(response, stored, fingerprint)
+                
+                try:
+                    result = await _write_add_item(
+                        db, order_id, request, resources,
+                        resources.idempotency.claim(idempotency_key, fingerprint)
+                    )
+                except IdempotencyReplayError:
+                    # Ключ успел записать другой процесс: отвечаем его ответом
+                    db.rollback()
+                    stored = await resources.idempotency.lookup(db, idempotency_key)
+                    if stored is None:
+                        raise HTTPException(
+                            status_code=409,
+                            detail="Запрос с этим Idempotency-Key еще выполняется, повторите позже"
+                        )
+                    return _replay_add_item(response, stored, fingerprint)
             
-            logger.info(f"Добавлен новый товар {request.nomenclature_id} в заказ {order_id}")
-        
-        db.commit()
-        
-        # Инвалидируем кэш после изменений
-        await cache_service.delete_pattern(f"order_full:order_id:{order_id}")
-        
-        # Записываем метрики
-        metrics_service.record_database_query("update", "orders")
-        metrics_service.record_database_query("insert", "order_items")
-        
-        if existing_item:
-            db.refresh(existing_item)
-            return AddItemToOrderResponse(
-                success=True,
-                message=f"Количество товара '{nomenclature.name}' увеличено",
-                order_item_id=existing_item.id,
-                total_quantity=existing_item.quantity
-            )
-        else:
-            db.refresh(new_item)
-            return AddItemToOrderResponse(
-                success=True,
-                message=f"Товар '{nomenclature.name}' добавлен в заказ",
-                order_item_id=new_item.id,
-                total_quantity=new_item.quantity
-            )
+            await resources.idempotency.remember(idempotency_key, fingerprint, result.model_dump_json())
+            return result
     
-    except HTTPException:
+    except (HTTPException, AdmissionRejected):
         db.rollback()
         raise
     except Exception as e:
@@ -209,106 +444,233 @@ async def add_item_to_order(
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
-@app.get("/orders/{order_id}", response_model=OrderInfo)
+@router.get("/orders/{order_id}", response_model=OrderInfo)
 async def get_order_info(
     order_id: int,
-    db: Session = Depends(get_db)
+    response: Response,
+    db: Session = Depends(get_read_db),
+    if_none_match: Optional[str] = Header(None),
+    x_request_timeout_ms: Optional[int] = Header(None),
+    resources: AppResources = Depends(get_resources)
 ):
-    """Получает информацию о заказе с его позициями"""
+    """
+    Получает информацию о заказе с его позициями.
+    Поддерживает условный GET: при совпадении If-None-Match возвращает 304.
+    Ответы из кэша не занимают слот admission control.
+    """
     try:
-        # Кэшируем полную информацию о заказе
-        cache_key = cache_service._generate_key("order_full", order_id=order_id)
+        # Кэшируем полную информацию о заказе вместе с ETag
+        cache_key = resources.cache._generate_key("order_full", order_id=order_id)
         
-        async def fetch_order_info():
-            order = db.query(Order).filter(Order.id == order_id).first()
-            if not order:
-                return None
-            
-            order_items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
-            
-            items_info = []
-            for item in order_items:
-                nomenclature = db.query(Nomenclature).filter(
-                    Nomenclature.id == item.nomenclature_id
-                ).first()
-                
-                items_info.append(OrderItemInfo(
-                    id=item.id,
-                    nomenclature_id=item.nomenclature_id,
-                    nomenclature_name=nomenclature.name if nomenclature else "Неизвестный товар",
-                    quantity=item.quantity,
-                    price=item.price,
-                    total_price=item.price * item.quantity
-                ))
-            
-            return OrderInfo(
-                id=order.id,
-                client_id=order.client_id,
-                client_name=order.client.name if order.client else "Неизвестный клиент",
-                order_date=order.order_date,
-                status=order.status,
-                total_amount=order.total_amount,
-                items=items_info
-            )
+        with timing_service.phase("cache"):
+            cache_entry = await resources.cache.get_entry(cache_key)
         
-        order_info = await cache_service.get_or_set(
-            cache_key,
-            fetch_order_info,
-            ttl=settings.CACHE_TTL_ORDERS
-        )
+        if cache_entry is not None:
+            order_info, etag = cache_entry['value'], cache_entry['etag']
+        else:
+            deadline = resources.admission.deadline(x_request_timeout_ms)
+            async with resources.admission.slot("get_order_info", deadline):
+                loaded = await asyncio.to_thread(repository.load_order_infos, db, [order_id])
+            fetched = loaded.get(order_id)
+            if not fetched:
+                raise HTTPException(status_code=404, detail=f"Заказ {order_id} не найден")
+            
+            order_info, etag = fetched
+            with timing_service.phase("cache"):
+                await resources.cache.set(cache_key, order_info, ttl=resources.settings.CACHE_TTL_ORDERS, etag=etag)
         
-        if not order_info:
-            raise HTTPException(status_code=404, detail=f"Заказ {order_id} не найден")
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
         
+        if etag:
+            response.headers["ETag"] = etag
         return order_info
     
-    except HTTPException:
+    except (HTTPException, AdmissionRejected):
         raise
     except Exception as e:
         logger.error(f"Ошибка при получении информации о заказе {order_id}: {str(e)}")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
-@app.get("/nomenclature/{nomenclature_id}", response_model=NomenclatureInfo)
+def _select_client_order_totals_in_shard(database: Database, shard: int) -> Dict[int, Decimal]:
+    db = database.shard_router.session(shard)
+    try:
+        return repository.select_client_order_totals(db)
+    finally:
+        db.close()
+
+@router.get("/clients/totals", response_model=List[ClientOrderTotal])
+async def get_client_order_totals(
+    db: Session = Depends(get_read_db),
+    database: Database = Depends(get_database),
+    resources: AppResources = Depends(get_resources)
+):
+    """
+    Сумма заказов по клиентам (запрос 2.1). При шардировании частичные
+    суммы считаются во всех шардах параллельно и складываются.
+    """
+    try:
+        with timing_service.phase("db"):
+            clients = db.query(Client.id, Client.name).all()
+            if database.shard_router is None:
+                partials = [repository.select_client_order_totals(db)]
+            else:
+                partials = await asyncio.gather(*(
+                    asyncio.to_thread(_select_client_order_totals_in_shard, database, shard)
+                    for shard in range(database.shard_router.shard_count)
+                ))
+        resources.metrics.record_database_query("select", "orders")
+        
+        with timing_service.phase("serialize"):
+            return repository.merge_client_order_totals(clients, partials)
+    
+    except Exception as e:
+        logger.error(f"Ошибка при расчете сумм заказов по клиентам: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+async def _load_nomenclature_batch(resources: AppResources, nomenclature_ids: List[int], db: Session) -> Dict[int, Any]:
+    """Загружает пачку товаров одним запросом с категориями и кладет их в кэш"""
+    with timing_service.phase("db"):
+        loaded = repository.load_nomenclature_infos(db, nomenclature_ids)
+    resources.metrics.record_database_query("select", "nomenclature")
+    
+    await resources.cache.set_many(
+        {
+            resources.cache._generate_key("nomenclature_full", nomenclature_id=nomenclature_id): fetched
+            for nomenclature_id, fetched in loaded.items()
+        },
+        ttl=resources.settings.CACHE_TTL_NOMENCLATURE
+    )
+    return loaded
+
+@router.get("/nomenclature", response_model=List[NomenclatureInfo])
+async def get_nomenclature_list(
+    ids: str = Query(..., description="ID товаров через запятую"),
+    db: Session = Depends(get_read_db),
+    resources: AppResources = Depends(get_resources)
+):
+    """
+    Получает информацию о нескольких товарах.
+    Товары возвращаются в порядке запроса, несуществующие ID пропускаются.
+    """
+    try:
+        nomenclature_ids = list(dict.fromkeys(int(part) for part in ids.split(",") if part.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids должен содержать целые числа через запятую")
+    
+    if not nomenclature_ids:
+        raise HTTPException(status_code=400, detail="Не указаны ID товаров")
+    max_ids = resources.settings.NOMENCLATURE_MULTI_GET_MAX_IDS
+    if len(nomenclature_ids) > max_ids:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Можно запросить не более {max_ids} товаров"
+        )
+    
+    try:
+        cache_keys = {
+            nomenclature_id: resources.cache._generate_key("nomenclature_full", nomenclature_id=nomenclature_id)
+            for nomenclature_id in nomenclature_ids
+        }
+        
+        with timing_service.phase("cache"):
+            cache_entries = await resources.cache.get_entries(list(cache_keys.values()))
+        
+        found = {
+            nomenclature_id: cache_entries[key]['value']
+            for nomenclature_id, key in cache_keys.items()
+            if key in cache_entries
+        }
+        
+        missing_ids = [nomenclature_id for nomenclature_id in nomenclature_ids if nomenclature_id not in found]
+        if missing_ids:
+            with timing_service.phase("batch"):
+                loaded = await resources.nomenclature_loader.load_many(missing_ids, db)
+            for nomenclature_id, fetched in loaded.items():
+                if fetched:
+                    found[nomenclature_id] = fetched[0]
+        
+        return [found[nomenclature_id] for nomenclature_id in nomenclature_ids if nomenclature_id in found]
+    
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка товаров: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+# Объявлен до /nomenclature/{nomenclature_id}, иначе "search" разбирается как ID
+@router.get("/nomenclature/search", response_model=NomenclatureSearchResponse)
+async def search_nomenclature(
+    q: str = Query(..., min_length=1, max_length=100, description="Строка поиска"),
+    category_id: Optional[int] = Query(None, description="Категория вместе с подкатегориями"),
+    in_stock: bool = Query(False, description="Только товары в наличии"),
+    limit: int = Query(20, ge=1),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_read_db),
+    resources: AppResources = Depends(get_resources)
+):
+    """
+    Поиск товаров по префиксу и подстроке названия.
+    Результаты ранжируются: полное совпадение, начало названия, начало слова, подстрока.
+    """
+    limit = min(limit, resources.settings.NOMENCLATURE_SEARCH_MAX_LIMIT)
+    query = normalize_query(q)
+    if not query:
+        raise HTTPException(status_code=400, detail="Пустой поисковый запрос")
+    
+    try:
+        search_index = resources.search_index
+        # Индекс строится в lifespan и обновляется фоновой задачей; пока его нет, ищем в БД
+        if resources.settings.NOMENCLATURE_SEARCH_BACKEND == "memory" and search_index.ready:
+            with timing_service.phase("search"):
+                total, items = search_index.search(query, category_id, in_stock, limit, offset)
+        else:
+            with timing_service.phase("db"):
+                total, items = repository.search_nomenclature(db, query, category_id, in_stock, limit, offset)
+        
+        return NomenclatureSearchResponse(total=total, limit=limit, offset=offset, items=items)
+    
+    except Exception as e:
+        logger.error(f"Ошибка поиска товаров по запросу '{q}': {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
+
+@router.get("/nomenclature/{nomenclature_id}", response_model=NomenclatureInfo)
 async def get_nomenclature_info(
     nomenclature_id: int,
-    db: Session = Depends(get_db)
+    response: Response,
+    db: Session = Depends(get_read_db),
+    if_none_match: Optional[str] = Header(None),
+    resources: AppResources = Depends(get_resources)
 ):
-    """Получает информацию о товаре"""
+    """
+    Получает информацию о товаре.
+    Поддерживает условный GET: при совпадении If-None-Match возвращает 304.
+    """
     try:
-        # Кэшируем информацию о товаре
-        cache_key = cache_service._generate_key("nomenclature_full", nomenclature_id=nomenclature_id)
+        # Кэшируем информацию о товаре вместе с ETag (кэш заполняет nomenclature_loader)
+        cache_key = resources.cache._generate_key("nomenclature_full", nomenclature_id=nomenclature_id)
         
-        async def fetch_nomenclature_info():
-            nomenclature = db.query(Nomenclature).filter(
-                Nomenclature.id == nomenclature_id
-            ).first()
-            
-            if not nomenclature:
-                return None
-            
-            category = db.query(Category).filter(
-                Category.id == nomenclature.category_id
-            ).first()
-            
-            return NomenclatureInfo(
-                id=nomenclature.id,
-                name=nomenclature.name,
-                quantity=nomenclature.quantity,
-                price=nomenclature.price,
-                category_id=nomenclature.category_id,
-                category_name=category.name if category else "Без категории"
-            )
+        with timing_service.phase("cache"):
+            cache_entry = await resources.cache.get_entry(cache_key)
         
-        nomenclature_info = await cache_service.get_or_set(
-            cache_key,
-            fetch_nomenclature_info,
-            ttl=settings.CACHE_TTL_NOMENCLATURE
-        )
+        if cache_entry is not None:
+            nomenclature_info, etag = cache_entry['value'], cache_entry['etag']
+        else:
+            # Промахи параллельных запросов объединяются в один запрос к БД
+            with timing_service.phase("batch"):
+                fetched = await resources.nomenclature_loader.load(nomenclature_id, db)
+            if not fetched:
+                raise HTTPException(status_code=404, detail=f"Товар {nomenclature_id} не найден")
+            
+            nomenclature_info, etag = fetched
         
-        if not nomenclature_info:
-            raise HTTPException(status_code=404, detail=f"Товар {nomenclature_id} не найден")
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
         
+        if etag:
+            response.headers["ETag"] = etag
         return nomenclature_info
     
     except HTTPException:
@@ -318,6 +680,82 @@ async def get_nomenclature_info(
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
+async def _admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """Перегрузка: 503 с Retry-After вместо ожидания соединения до таймаута"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Сервис перегружен, повторите запрос позже"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+def create_app(app_settings: Settings = settings) -> FastAPI:
+    """
+    Создает приложение со своими ресурсами (пулы БД, кэш, метрики).
+    Пулы и метрики открываются в lifespan, до приема трафика, и
+    закрываются при остановке.
+    """
+    resources = AppResources(app_settings)
+    
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        configure_logging(app_settings)
+        await resources.open()
+        yield
+        await resources.close()
+    
+    app = FastAPI(
+        title="Test Task API",
+        version="1.0.0",
+        description="API для управления заказами",
+        lifespan=lifespan
+    )
+    app.state.resources = resources
+    
+    # Промахи по товарам из параллельных запросов объединяются в один запрос к БД
+    resources.nomenclature_loader = BatchLoader(
+        partial(_load_nomenclature_batch, resources),
+        window_ms=app_settings.NOMENCLATURE_BATCH_WINDOW_MS,
+        max_batch_size=app_settings.NOMENCLATURE_BATCH_MAX_SIZE
+    )
+    
+    # Режим group commit: добавления копятся в очереди и фиксируются общими транзакциями
+    resources.add_item_writer = GroupCommitWriter(
+        _apply_add_item,
+        max_batch_size=app_settings.GROUP_COMMIT_MAX_BATCH,
+        interval_ms=app_settings.GROUP_COMMIT_INTERVAL_MS,
+        on_batch=lambda batch_size: resources.metrics.record_group_commit(batch_size)
+    )
+    
+    # Admission control: лимиты параллельности маршрутов, работающих с БД
+    resources.admission = AdmissionController(
+        limits={
+            "add_item_to_order": app_settings.ADMISSION_ADD_ITEM_CONCURRENCY,
+            "get_order_info": app_settings.ADMISSION_ORDER_READ_CONCURRENCY
+        },
+        max_queue=app_settings.ADMISSION_MAX_QUEUE,
+        default_timeout_ms=app_settings.ADMISSION_DEFAULT_TIMEOUT_MS,
+        enabled=app_settings.ADMISSION_CONTROL_ENABLED,
+        on_wait=lambda route, duration: resources.metrics.record_admission_wait(route, duration),
+        on_queue_depth=lambda route, depth: resources.metrics.set_admission_queue_depth(route, depth),
+        on_shed=lambda route, reason: resources.metrics.record_admission_shed(route, reason)
+    )
+    app.add_exception_handler(AdmissionRejected, _admission_rejected_handler)
+    
+    # CORS middleware
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.middleware("http")(log_requests_and_metrics)
+    app.include_router(router)
+    
+    return app
+
+app = create_app(settings)
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host=settings.APP_HOST, port=settings.APP_PORT)
@@ -1,71 +1,146 @@
 import time
 from typing import Dict, Any
-from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Метрики Prometheus
-REQUEST_COUNT = Counter(
-    'http_requests_total', 
-    'Total HTTP requests', 
-    ['method', 'endpoint', 'status']
-)
-
-REQUEST_DURATION = Histogram(
-    'http_request_duration_seconds',
-    'HTTP request duration in seconds',
-    ['method', 'endpoint']
-)
-
-ACTIVE_CONNECTIONS = Gauge(
-    'active_connections',
-    'Number of active connections'
-)
-
-CACHE_HITS = Counter(
-    'cache_hits_total',
-    'Total cache hits',
-    ['cache_type']
-)
-
-CACHE_MISSES = Counter(
-    'cache_misses_total',
-    'Total cache misses',
-    ['cache_type']
-)
-
-DATABASE_QUERIES = Counter(
-    'database_queries_total',
-    'Total database queries',
-    ['operation', 'table']
-)
-
 class MetricsService:
-    def __init__(self):
+    def __init__(self, registry=None):
+        # prometheus_client импортируется при создании сервиса (в lifespan),
+        # а не при импорте модуля. У каждого экземпляра свой реестр метрик,
+        # поэтому несколько приложений (например, в тестах) не конфликтуют.
+        from prometheus_client import (
+            CollectorRegistry, Counter, Histogram, Gauge,
+            ProcessCollector, PlatformCollector, GCCollector
+        )
+        
+        if registry is None:
+            registry = CollectorRegistry()
+            ProcessCollector(registry=registry)
+            PlatformCollector(registry=registry)
+            GCCollector(registry=registry)
+        self.registry = registry
+        
         self._start_time = time.time()
         self._request_times: Dict[str, float] = {}
+        
+        # Метрики Prometheus
+        self.request_count = Counter(
+            'http_requests_total', 
+            'Total HTTP requests', 
+            ['method', 'endpoint', 'status'],
+            registry=registry
+        )
+        
+        self.request_duration = Histogram(
+            'http_request_duration_seconds',
+            'HTTP request duration in seconds',
+            ['method', 'endpoint'],
+            registry=registry
+        )
+        
+        self.request_phase_duration = Histogram(
+            'http_request_phase_duration_seconds',
+            'HTTP request phase duration in seconds',
+            ['endpoint', 'phase'],
+            registry=registry
+        )
+        
+        self.active_connections = Gauge(
+            'active_connections',
+            'Number of active connections',
+            registry=registry
+        )
+        
+        self.cache_hits = Counter(
+            'cache_hits_total',
+            'Total cache hits',
+            ['cache_type'],
+            registry=registry
+        )
+        
+        self.cache_misses = Counter(
+            'cache_misses_total',
+            'Total cache misses',
+            ['cache_type'],
+            registry=registry
+        )
+        
+        self.database_queries = Counter(
+            'database_queries_total',
+            'Total database queries',
+            ['operation', 'table'],
+            registry=registry
+        )
+        
+        self.group_commit_batch_size = Histogram(
+            'group_commit_batch_size',
+            'Number of writes applied in one group commit transaction',
+            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+            registry=registry
+        )
+        
+        self.admission_queue_depth = Gauge(
+            'admission_queue_depth',
+            'Requests waiting for an admission slot',
+            ['route'],
+            registry=registry
+        )
+        
+        self.admission_wait = Histogram(
+            'admission_wait_seconds',
+            'Time spent waiting for an admission slot',
+            ['route'],
+            registry=registry
+        )
+        
+        self.admission_shed = Counter(
+            'admission_shed_total',
+            'Requests rejected by admission control',
+            ['route', 'reason'],
+            registry=registry
+        )
     
     def record_request(self, method: str, endpoint: str, status_code: int, duration: float):
         """Записывает метрику запроса"""
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status_code).inc()
-        REQUEST_DURATION.labels(method=method, endpoint=endpoint).observe(duration)
+        self.request_count.labels(method=method, endpoint=endpoint, status=status_code).inc()
+        self.request_duration.labels(method=method, endpoint=endpoint).observe(duration)
+    
+    def record_request_phase(self, endpoint: str, phase: str, duration: float):
+        """Записывает длительность фазы запроса"""
+        self.request_phase_duration.labels(endpoint=endpoint, phase=phase).observe(duration)
     
     def record_cache_hit(self, cache_type: str):
         """Записывает попадание в кэш"""
-        CACHE_HITS.labels(cache_type=cache_type).inc()
+        self.cache_hits.labels(cache_type=cache_type).inc()
     
     def record_cache_miss(self, cache_type: str):
         """Записывает промах кэша"""
-        CACHE_MISSES.labels(cache_type=cache_type).inc()
+        self.cache_misses.labels(cache_type=cache_type).inc()
     
     def record_database_query(self, operation: str, table: str):
         """Записывает запрос к базе данных"""
-        DATABASE_QUERIES.labels(operation=operation, table=table).inc()
+        self.database_queries.labels(operation=operation, table=table).inc()
+    
+    def record_group_commit(self, batch_size: int):
+        """Записывает размер пачки group commit"""
+        self.group_commit_batch_size.observe(batch_size)
+    
+    def record_admission_wait(self, route: str, duration: float):
+        """Записывает время ожидания слота маршрута"""
+        self.admission_wait.labels(route=route).observe(duration)
+    
+    def set_admission_queue_depth(self, route: str, depth: int):
+        """Устанавливает длину очереди маршрута"""
+        self.admission_queue_depth.labels(route=route).set(depth)
+    
+    def record_admission_shed(self, route: str, reason: str):
+        """Записывает отклоненный запрос"""
+        self.admission_shed.labels(route=route, reason=reason).inc()
     
     def set_active_connections(self, count: int):
         """Устанавливает количество активных соединений"""
-        ACTIVE_CONNECTIONS.set(count)
+        self.active_connections.set(count)
     
     def get_uptime(self) -> float:
         """Возвращает время работы приложения"""
@@ -73,7 +148,9 @@ class MetricsService:
     
     def get_metrics(self) -> str:
         """Возвращает метрики в формате Prometheus"""
-        return generate_latest().decode('utf-8')
+        from prometheus_client import generate_latest
+        
+        return generate_latest(self.registry).decode('utf-8')
     
     def get_health_status(self) -> Dict[str, Any]:
         """Возвращает статус здоровья приложения"""
@@ -101,6 +178,3 @@ class MetricsService:
             return f"{minutes}m {secs}s"
         else:
             return f"{secs}s"
-
-# Глобальный экземпляр сервиса метрик
-metrics_service = MetricsService()
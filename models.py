@@ -50,3 +50,14 @@ class NomenclatureInfo(BaseModel):
     price: Decimal
     category_id: int
     category_name: str
+
+class NomenclatureSearchResponse(BaseModel):
+    total: int
+    limit: int
+    offset: int
+    items: List[NomenclatureInfo] = []
+
+class ClientOrderTotal(BaseModel):
+    client_id: int
+    client_name: str
+    total_amount: Decimal
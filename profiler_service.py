@@ -0,0 +1,87 @@
+import sys
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ProfilerBusyError(RuntimeError):
+    """Профилирование уже запущено"""
+
+class SamplingProfiler:
+    """
+    Статистический профайлер: фоновый поток раз в interval снимает стеки
+    всех потоков процесса через sys._current_frames(). Сам процесс не
+    инструментируется, поэтому накладные расходы определяются только
+    частотой выборки.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks: Counter = Counter()
+        self._samples = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float = 0.005) -> None:
+        """Запускает сбор выборок"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("Профилирование уже выполняется")
+
+        self._stacks = Counter()
+        self._samples = 0
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval,),
+            name="sampling-profiler",
+            daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Sampling profiler started, interval: {interval * 1000:.1f}ms")
+
+    def stop(self) -> str:
+        """Останавливает сбор и возвращает стеки в collapsed-формате"""
+        if self._thread is None:
+            return ""
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self._lock.release()
+
+        logger.info(f"Sampling profiler stopped, samples: {self._samples}")
+        return self.format_collapsed(self._stacks)
+
+    def _run(self, interval: float) -> None:
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_ident:
+                    continue
+                self._stacks[self._collapse(frame)] += 1
+            self._samples += 1
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        """Сворачивает стек в строку 'корень;...;лист'"""
+        stack: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    @staticmethod
+    def format_collapsed(stacks: Dict[str, int]) -> str:
+        """Формат flamegraph.pl / speedscope: 'стек количество' на строку"""
+        lines = [f"{stack} {count}" for stack, count in sorted(stacks.items())]
+        return "\n".join(lines) + ("\n" if lines else "")
+
+# Глобальный экземпляр профайлера
+profiler_service = SamplingProfiler()
@@ -0,0 +1,201 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+import logging
+
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+
+from database import Order, OrderItem, Nomenclature, Category
+from models import OrderInfo, OrderItemInfo, NomenclatureInfo, ClientOrderTotal
+from http_cache import make_etag
+from timing_service import timing_service
+import statements
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_ORDER_STATUSES = ("pending", "processing")
+
+def build_nomenclature_info(nomenclature: Nomenclature, category: Optional[Category]) -> Tuple[NomenclatureInfo, str]:
+    """Строит NomenclatureInfo и ETag товара"""
+    nomenclature_info = NomenclatureInfo(
+        id=nomenclature.id,
+        name=nomenclature.name,
+        quantity=nomenclature.quantity,
+        price=nomenclature.price,
+        category_id=nomenclature.category_id,
+        category_name=category.name if category else "Без категории"
+    )
+    etag = make_etag(
+        "nomenclature",
+        nomenclature.id,
+        nomenclature.updated_at,
+        category.updated_at if category else None
+    )
+    return nomenclature_info, etag
+
+def nomenclature_info_from_row(row) -> Tuple[NomenclatureInfo, str]:
+    """То же, что build_nomenclature_info, для строки statements.nomenclature_rows"""
+    nomenclature_info = NomenclatureInfo(
+        id=row.id,
+        name=row.name,
+        quantity=row.quantity,
+        price=row.price,
+        category_id=row.category_id,
+        category_name=row.category_name if row.category_name is not None else "Без категории"
+    )
+    etag = make_etag("nomenclature", row.id, row.updated_at, row.category_updated_at)
+    return nomenclature_info, etag
+
+def load_nomenclature_infos(db: Session, nomenclature_ids: List[int]) -> Dict[int, Tuple[NomenclatureInfo, str]]:
+    """Загружает товары одним запросом вместе с категориями (строки Core, без ORM-объектов)"""
+    if not nomenclature_ids:
+        return {}
+    
+    return {
+        row.id: nomenclature_info_from_row(row)
+        for row in statements.nomenclature_rows(db, nomenclature_ids)
+    }
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def search_nomenclature(
+    db: Session,
+    query: str,
+    category_id: Optional[int] = None,
+    in_stock: bool = False,
+    limit: int = 20,
+    offset: int = 0
+) -> Tuple[int, List[NomenclatureInfo]]:
+    """
+    Поиск товаров по подстроке названия в БД. В PostgreSQL LIKE по
+    lower(name) использует триграммный индекс idx_nomenclature_name_trgm.
+    Ранги совпадают с in-memory индексом: полное совпадение, префикс
+    названия, префикс слова, подстрока.
+    """
+    pattern = _escape_like(query)
+    name = func.lower(Nomenclature.name)
+    filters = [name.like(f"%{pattern}%", escape="\\")]
+    
+    if category_id is not None:
+        subtree = select(Category.id).where(Category.id == category_id).cte("category_subtree", recursive=True)
+        subtree = subtree.union_all(select(Category.id).where(Category.parent_id == subtree.c.id))
+        filters.append(Nomenclature.category_id.in_(select(subtree.c.id)))
+    if in_stock:
+        filters.append(Nomenclature.quantity > 0)
+    
+    total = db.query(func.count(Nomenclature.id)).filter(*filters).scalar()
+    rank = case(
+        (name == query, 0),
+        (name.like(f"{pattern}%", escape="\\"), 1),
+        (name.like(f"% {pattern}%", escape="\\"), 2),
+        else_=3
+    )
+    rows = db.query(Nomenclature, Category).outerjoin(
+        Category, Category.id == Nomenclature.category_id
+    ).filter(*filters).order_by(
+        rank, func.length(Nomenclature.name), name, Nomenclature.id
+    ).offset(offset).limit(limit).all()
+    
+    return total, [build_nomenclature_info(nomenclature, category)[0] for nomenclature, category in rows]
+
+def load_order_infos(db: Session, order_ids: List[int]) -> Dict[int, Tuple[OrderInfo, str]]:
+    """
+    Загружает заказы двумя запросами: заказы с клиентами и позиции всех
+    заказов с названиями товаров. Чтение идет строками Core из statements.
+    """
+    if not order_ids:
+        return {}
+
+    with timing_service.phase("db"):
+        orders = statements.order_rows(db, order_ids)
+
+        items_by_order: Dict[int, list] = {order.id: [] for order in orders}
+        if items_by_order:
+            for item in statements.order_item_rows(db, list(items_by_order)):
+                items_by_order[item.order_id].append(item)
+
+    loaded = {}
+    with timing_service.phase("serialize"):
+        for order in orders:
+            order_items = items_by_order[order.id]
+            items_info = [
+                OrderItemInfo(
+                    id=item.id,
+                    nomenclature_id=item.nomenclature_id,
+                    nomenclature_name=item.nomenclature_name if item.nomenclature_name is not None else "Неизвестный товар",
+                    quantity=item.quantity,
+                    price=item.price,
+                    total_price=item.price * item.quantity
+                )
+                for item in order_items
+            ]
+
+            order_info = OrderInfo(
+                id=order.id,
+                client_id=order.client_id,
+                client_name=order.client_name if order.client_name is not None else "Неизвестный клиент",
+                order_date=order.order_date,
+                status=order.status,
+                total_amount=order.total_amount,
+                items=items_info
+            )
+
+            # Любое изменение заказа увеличивает orders.version (инкремент суммы
+            # в SQL или ORM-обновление через version_id_col); клиент и товары
+            # версионируются по updated_at
+            versions = [order.client_updated_at]
+            versions += [item.nomenclature_updated_at for item in order_items if item.nomenclature_updated_at is not None]
+            loaded[order.id] = (order_info, make_etag("order", order.id, *versions, revision=order.version))
+
+    return loaded
+
+def select_hot_nomenclature_sales(db: Session, limit: int, days: int) -> Dict[int, int]:
+    """Продажи (сумма количества) самых продаваемых товаров за последние days дней: ID -> количество"""
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = db.query(
+        OrderItem.nomenclature_id, func.sum(OrderItem.quantity).label("sold")
+    ).join(
+        Order, Order.id == OrderItem.order_id
+    ).filter(
+        Order.order_date >= since
+    ).group_by(
+        OrderItem.nomenclature_id
+    ).order_by(
+        func.sum(OrderItem.quantity).desc()
+    ).limit(limit).all()
+    return {row.nomenclature_id: int(row.sold) for row in rows}
+
+def select_recent_active_orders(db: Session, limit: int) -> List[Tuple[int, datetime]]:
+    """Последние активные заказы: (ID, дата заказа) от новых к старым"""
+    rows = db.query(Order.id, Order.order_date).filter(
+        Order.status.in_(ACTIVE_ORDER_STATUSES)
+    ).order_by(
+        Order.order_date.desc()
+    ).limit(limit).all()
+    return [(row.id, row.order_date) for row in rows]
+
+def select_client_order_totals(db: Session) -> Dict[int, Decimal]:
+    """Суммы заказов по клиентам в одной базе (часть запроса 2.1 для шарда)"""
+    rows = db.query(
+        Order.client_id, func.coalesce(func.sum(Order.total_amount), 0)
+    ).group_by(Order.client_id).all()
+    return {client_id: Decimal(total) for client_id, total in rows}
+
+def merge_client_order_totals(clients: List[Tuple[int, str]], partials: List[Dict[int, Decimal]]) -> List[ClientOrderTotal]:
+    """
+    Собирает запрос 2.1 из частичных сумм шардов: клиенты без заказов
+    получают 0, сортировка по сумме по убыванию.
+    """
+    totals: Dict[int, Decimal] = {}
+    for partial in partials:
+        for client_id, total in partial.items():
+            totals[client_id] = totals.get(client_id, Decimal("0")) + total
+    
+    result = [
+        ClientOrderTotal(client_id=client_id, client_name=name, total_amount=totals.get(client_id, Decimal("0")))
+        for client_id, name in clients
+    ]
+    result.sort(key=lambda row: (-row.total_amount, row.client_id))
+    return result
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from functools import partial
+from typing import Callable, List
+
+from fastapi import Request
+
+from config import Settings
+from cache_service import CacheService
+from idempotency_service import IdempotencyService, purge_expired_keys
+from search_service import NomenclatureSearchIndex
+
+logger = logging.getLogger(__name__)
+
+class AppResources:
+    """
+    Ресурсы одного экземпляра приложения: настройки, пулы БД, кэш и метрики.
+
+    Пулы соединений и метрики создаются при первом обращении: lifespan
+    открывает их до приема трафика, а приложение, запущенное без lifespan
+    (например, TestClient без контекстного менеджера), создаст их по
+    требованию. close() закрывает пулы при остановке.
+
+    Периодическое обслуживание (копирование справочников в шарды,
+    обновление поискового индекса, удаление истекших ключей идемпотентности) выполняется фоновыми задачами
+    lifespan в пуле потоков, чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, app_settings: Settings):
+        self.settings = app_settings
+        # Попадания и промахи кэша экспортируются в cache_hits_total / cache_misses_total
+        self.cache = CacheService(
+            on_hit=lambda prefix: self.metrics.record_cache_hit(prefix),
+            on_miss=lambda prefix: self.metrics.record_cache_miss(prefix)
+        )
+        self.idempotency = IdempotencyService(
+            ttl_seconds=app_settings.IDEMPOTENCY_TTL_SECONDS,
+            max_entries=app_settings.IDEMPOTENCY_MAX_ENTRIES,
+            backend=app_settings.IDEMPOTENCY_BACKEND,
+            redis_url=app_settings.redis_url
+        )
+        self.ready = False
+        self._tasks: List[asyncio.Task] = []
+        self._database = None
+        self._metrics = None
+        # Создаются в create_app: зависят от обработчиков приложения
+        self.nomenclature_loader = None
+        self.add_item_writer = None
+        self.admission = None
+        self.search_index = NomenclatureSearchIndex()
+
+    @property
+    def database(self):
+        if self._database is None:
+            from database import Database
+
+            self._database = Database(self.settings)
+        return self._database
+
+    @property
+    def metrics(self):
+        if self._metrics is None:
+            from metrics_service import MetricsService
+
+            self._metrics = MetricsService()
+        return self._metrics
+
+    async def open(self) -> None:
+        """Открывает пулы БД, кэш и метрики до приема трафика"""
+        self.metrics  # создает реестр метрик
+
+        if self.settings.CACHE_SNAPSHOT_PATH:
+            try:
+                self.cache.load_snapshot(self.settings.CACHE_SNAPSHOT_PATH)
+            except Exception as e:
+                logger.error(f"Не удалось загрузить снимок кэша: {str(e)}")
+
+        router = self.database.shard_router
+        if router is not None:
+            try:
+                copied = await asyncio.to_thread(router.replicate_reference_data)
+                logger.info(f"Справочники скопированы в шарды: {copied}")
+            except Exception as e:
+                logger.error(f"Ошибка копирования справочников в шарды: {str(e)}")
+            if self.settings.SHARD_REFERENCE_SYNC_SECONDS > 0:
+                self._start_periodic(
+                    "shard-reference-sync",
+                    self.settings.SHARD_REFERENCE_SYNC_SECONDS,
+                    partial(router.replicate_reference_data, incremental=True)
+                )
+
+        if self.settings.CACHE_WARMUP_ENABLED:
+            from cache_warmup import warm_up_cache
+
+            try:
+                self.database.ping()
+                shards = [session_factory() for session_factory in self.database.order_session_factories]
+                try:
+                    await warm_up_cache(shards, self.cache, self.settings)
+                finally:
+                    for db in shards:
+                        db.close()
+            except Exception as e:
+                # Сервис все равно становится готовым: без прогрева он работает через БД
+                logger.error(f"Ошибка прогрева кэша: {str(e)}")
+
+        if self.settings.NOMENCLATURE_SEARCH_BACKEND == "memory":
+            try:
+                await asyncio.to_thread(self.refresh_search_index)
+            except Exception as e:
+                # До построения индекса поиск идет через БД
+                logger.error(f"Ошибка построения поискового индекса: {str(e)}")
+            self._start_periodic(
+                "search-index-refresh",
+                self.settings.NOMENCLATURE_SEARCH_REFRESH_SECONDS,
+                self.refresh_search_index
+            )
+
+        if self.settings.IDEMPOTENCY_PURGE_INTERVAL_SECONDS > 0:
+            self._start_periodic(
+                "idempotency-purge",
+                self.settings.IDEMPOTENCY_PURGE_INTERVAL_SECONDS,
+                self.purge_idempotency_keys
+            )
+
+        self.ready = True
+
+    async def close(self) -> None:
+        """Останавливает фоновые задачи, сохраняет снимок кэша и закрывает пулы соединений"""
+        self.ready = False
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        if self.settings.CACHE_SNAPSHOT_PATH:
+            try:
+                self.cache.save_snapshot(self.settings.CACHE_SNAPSHOT_PATH)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить снимок кэша: {str(e)}")
+
+        if self._database is not None:
+            self._database.dispose()
+            self._database = None
+
+    def refresh_search_index(self) -> None:
+        """Дочитывает изменения каталога в поисковый индекс (в фоновом потоке)"""
+        db = self.database.SessionLocal()
+        try:
+            self.search_index.refresh(db)
+        finally:
+            db.close()
+
+    def purge_idempotency_keys(self) -> int:
+        """Удаляет истекшие ключи идемпотентности во всех базах (шардах); возвращает их число"""
+        purged = 0
+        for session_factory in self.database.order_session_factories:
+            db = session_factory()
+            try:
+                purged += purge_expired_keys(db, self.settings.IDEMPOTENCY_TTL_SECONDS)
+            finally:
+                db.close()
+        if purged:
+            logger.info(f"Удалено истекших ключей идемпотентности: {purged}")
+        return purged
+
+    def _start_periodic(self, name: str, interval: float, job: Callable[[], object]) -> None:
+        """Запускает job в пуле потоков каждые interval секунд до close()"""
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await asyncio.to_thread(job)
+                except Exception as e:
+                    logger.error(f"Ошибка фоновой задачи {name}: {str(e)}")
+
+        self._tasks.append(asyncio.create_task(run(), name=name))
+
+def get_resources(request: Request) -> AppResources:
+    return request.app.state.resources
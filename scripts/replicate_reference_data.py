@@ -0,0 +1,37 @@
+"""
+Копирует справочники (категории, товары, клиенты) из шарда 0 во все
+остальные шарды из SHARD_DATABASE_URLS.
+
+Приложение делает то же самое при старте и каждые
+SHARD_REFERENCE_SYNC_SECONDS; скрипт нужен после массовой загрузки
+справочников или когда периодическая синхронизация отключена.
+
+Запуск (из корня проекта):
+    SHARD_DATABASE_URLS=postgresql://...,postgresql://... python scripts/replicate_reference_data.py
+"""
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import settings
+from database import Database
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    database = Database(settings)
+    if database.shard_router is None:
+        print("SHARD_DATABASE_URLS не задан: шардирование выключено, копировать нечего")
+        return 1
+
+    try:
+        copied = database.shard_router.replicate_reference_data()
+    finally:
+        database.dispose()
+    for table, count in copied.items():
+        print(f"{table:16} {count}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+import bisect
+import heapq
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+import logging
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database import Nomenclature, Category
+from models import NomenclatureInfo
+from repository import build_nomenclature_info
+
+logger = logging.getLogger(__name__)
+
+# Доля измененных товаров, начиная с которой индекс перестраивается целиком:
+# вставка в отсортированный список слов стоит O(n), и массовое изменение
+# под блокировкой остановило бы поиск
+REBUILD_CHANGED_FRACTION = 0.05
+REBUILD_MIN_CHANGED = 100
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def match_rank(name: str, query: str) -> int:
+    """Ранг совпадения: 0 — полное, 1 — префикс названия, 2 — префикс слова, 3 — подстрока"""
+    if name == query:
+        return 0
+    if name.startswith(query):
+        return 1
+    if f" {query}" in name:
+        return 2
+    return 3
+
+@dataclass
+class _Document:
+    info: NomenclatureInfo
+    name: str
+    tokens: Tuple[str, ...]
+
+class NomenclatureSearchIndex:
+    """
+    In-memory индекс каталога для поиска и автодополнения.
+
+    Префиксы слов ищутся бинарным поиском по отсортированному списку
+    (слово, id), подстроки от трех символов — пересечением множеств
+    триграмм с проверкой вхождения. Более короткие запросы совпадают
+    только с началом слов.
+
+    Индекс обновляется инкрементально: refresh() дочитывает товары,
+    измененные после последнего обновления (по updated_at), и полностью
+    перестраивается при изменении категорий или удалении товаров.
+
+    refresh() и rebuild() рассчитаны на вызов из фонового потока: чтение
+    из БД и построение нового индекса идут без блокировки, а под _lock
+    только применяются небольшие пачки изменений и подменяются структуры.
+    Если изменилось больше REBUILD_CHANGED_FRACTION каталога, индекс
+    перестраивается вне блокировки.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._documents: Dict[int, _Document] = {}
+        self._tokens: List[Tuple[str, int]] = []
+        self._trigram_postings: Dict[str, Set[int]] = {}
+        self._children: Dict[Optional[int], List[int]] = {}
+        self._watermark: Optional[datetime] = None
+        self._category_watermark: Optional[datetime] = None
+        self._refreshed_at: Optional[float] = None
+
+    @property
+    def size(self) -> int:
+        return len(self._documents)
+
+    @property
+    def ready(self) -> bool:
+        """Индекс хотя бы раз построен"""
+        return self._refreshed_at is not None
+
+    def upsert(self, info: NomenclatureInfo, keep_sorted: bool = True) -> None:
+        """Добавляет или обновляет товар в индексе"""
+        self.remove(info.id)
+        name = normalize_query(info.name)
+        document = _Document(info=info, name=name, tokens=tuple(dict.fromkeys(name.split())))
+        self._documents[info.id] = document
+        for token in document.tokens:
+            if keep_sorted:
+                bisect.insort(self._tokens, (token, info.id))
+            else:
+                self._tokens.append((token, info.id))
+        for trigram in _trigrams(name):
+            self._trigram_postings.setdefault(trigram, set()).add(info.id)
+
+    def remove(self, nomenclature_id: int) -> None:
+        document = self._documents.pop(nomenclature_id, None)
+        if document is None:
+            return
+        for token in document.tokens:
+            position = bisect.bisect_left(self._tokens, (token, nomenclature_id))
+            if position < len(self._tokens) and self._tokens[position] == (token, nomenclature_id):
+                del self._tokens[position]
+        for trigram in _trigrams(document.name):
+            postings = self._trigram_postings.get(trigram)
+            if postings is not None:
+                postings.discard(nomenclature_id)
+                if not postings:
+                    del self._trigram_postings[trigram]
+
+    def set_categories(self, categories: List[Tuple[int, Optional[int]]]) -> None:
+        """Запоминает дерево категорий: список (id, parent_id)"""
+        children: Dict[Optional[int], List[int]] = {}
+        for category_id, parent_id in categories:
+            children.setdefault(parent_id, []).append(category_id)
+        self._children = children
+
+    def category_subtree(self, category_id: int) -> Set[int]:
+        subtree = {category_id}
+        stack = [category_id]
+        while stack:
+            for child_id in self._children.get(stack.pop(), ()):
+                if child_id not in subtree:
+                    subtree.add(child_id)
+                    stack.append(child_id)
+        return subtree
+
+    def search(
+        self,
+        query: str,
+        category_id: Optional[int] = None,
+        in_stock: bool = False,
+        limit: int = 20,
+        offset: int = 0
+    ) -> Tuple[int, List[NomenclatureInfo]]:
+        """Возвращает (число найденных, страница результатов) в порядке ранга"""
+        query = normalize_query(query)
+        if not query:
+            return 0, []
+
+        with self._lock:
+            if len(query) >= 3:
+                candidates = self._substring_candidates(query)
+            else:
+                candidates = self._prefix_candidates(query)
+
+            categories = self.category_subtree(category_id) if category_id is not None else None
+            matches = []
+            for nomenclature_id in candidates:
+                document = self._documents[nomenclature_id]
+                if categories is not None and document.info.category_id not in categories:
+                    continue
+                if in_stock and document.info.quantity <= 0:
+                    continue
+                matches.append(document)
+
+        # Сортируется только начало выдачи до конца запрошенной страницы
+        page = heapq.nsmallest(offset + limit, matches, key=lambda document: (
+            match_rank(document.name, query), len(document.name), document.name, document.info.id
+        ))
+        return len(matches), [document.info for document in page[offset:]]
+
+    def _prefix_candidates(self, query: str) -> Set[int]:
+        candidates = set()
+        position = bisect.bisect_left(self._tokens, (query, -1))
+        while position < len(self._tokens) and self._tokens[position][0].startswith(query):
+            candidates.add(self._tokens[position][1])
+            position += 1
+        return candidates
+
+    def _substring_candidates(self, query: str) -> Set[int]:
+        postings = sorted(
+            (self._trigram_postings.get(trigram, set()) for trigram in _trigrams(query)),
+            key=len
+        )
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates &= posting
+            if not candidates:
+                break
+        return {
+            nomenclature_id for nomenclature_id in candidates
+            if query in self._documents[nomenclature_id].name
+        }
+
+    def refresh(self, db: Session) -> None:
+        """Дочитывает изменения каталога из БД"""
+        category_watermark = db.query(func.max(Category.updated_at)).scalar()
+        if self._watermark is None or category_watermark != self._category_watermark:
+            self.rebuild(db)
+            return
+
+        rows = db.query(Nomenclature, Category).outerjoin(
+            Category, Category.id == Nomenclature.category_id
+        ).filter(
+            Nomenclature.updated_at >= self._watermark
+        ).all()
+        if len(rows) > max(REBUILD_CHANGED_FRACTION * len(self._documents), REBUILD_MIN_CHANGED):
+            self.rebuild(db)
+            return
+
+        count = db.query(func.count(Nomenclature.id)).scalar()
+        with self._lock:
+            self._index_rows(rows)
+            # Удаления по updated_at не видны: расхождение числа товаров — повод перестроить индекс
+            deleted = count != len(self._documents)
+        if deleted:
+            self.rebuild(db)
+            return
+        self._refreshed_at = time.monotonic()
+
+    def rebuild(self, db: Session) -> None:
+        """Полностью перестраивает индекс: строит новый и подменяет им текущий"""
+        started = time.perf_counter()
+        fresh = NomenclatureSearchIndex()
+        fresh.set_categories(db.query(Category.id, Category.parent_id).all())
+        fresh._category_watermark = db.query(func.max(Category.updated_at)).scalar()
+        rows = db.query(Nomenclature, Category).outerjoin(
+            Category, Category.id == Nomenclature.category_id
+        ).all()
+        fresh._index_rows(rows, keep_sorted=False)
+        fresh._tokens.sort()
+
+        with self._lock:
+            self._documents = fresh._documents
+            self._tokens = fresh._tokens
+            self._trigram_postings = fresh._trigram_postings
+            self._children = fresh._children
+            self._watermark = fresh._watermark or datetime.min
+            self._category_watermark = fresh._category_watermark
+        self._refreshed_at = time.monotonic()
+
+        logger.info(
+            f"Nomenclature search index rebuilt: {len(fresh._documents)} items, "
+            f"{time.perf_counter() - started:.3f}s"
+        )
+
+    def _index_rows(self, rows, keep_sorted: bool = True) -> None:
+        for nomenclature, category in rows:
+            info, _ = build_nomenclature_info(nomenclature, category)
+            self.upsert(info, keep_sorted)
+            if nomenclature.updated_at is not None and (
+                self._watermark is None or nomenclature.updated_at > self._watermark
+            ):
+                self._watermark = nomenclature.updated_at
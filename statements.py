@@ -0,0 +1,90 @@
+"""
+Готовые выражения для горячих запросов.
+
+Выражения строятся через lambda_stmt: SQLAlchemy кэширует построенное
+и скомпилированное выражение по коду лямбды, а значения из замыкания
+(ID, количества) подставляет как параметры. Повторный запрос не строит
+ORM-конструкцию и не компилирует SQL заново.
+
+Чтения возвращают строки Core (Row) без загрузки ORM-объектов в сессию:
+без identity map, отслеживания изменений и событий загрузки. Поля строк
+доступны по именам, как атрибуты модели.
+"""
+from decimal import Decimal
+from typing import List, Optional, Sequence
+
+from sqlalchemy import lambda_stmt, select, update
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from database import Order, OrderItem, Nomenclature, Client, Category
+
+def order_exists(db: Session, order_id: int) -> bool:
+    stmt = lambda_stmt(lambda: select(Order.id).where(Order.id == order_id))
+    return db.execute(stmt).first() is not None
+
+def nomenclature_stock(db: Session, nomenclature_id: int) -> Optional[Row]:
+    """Товар для проверки остатка: id, name, quantity, price"""
+    stmt = lambda_stmt(lambda: select(
+        Nomenclature.id, Nomenclature.name, Nomenclature.quantity, Nomenclature.price
+    ).where(Nomenclature.id == nomenclature_id))
+    return db.execute(stmt).first()
+
+def increment_order_item(db: Session, order_id: int, nomenclature_id: int,
+                         quantity: int, price: Decimal) -> Optional[Row]:
+    """Увеличивает количество позиции заказа; возвращает (id, quantity) или None"""
+    stmt = lambda_stmt(lambda: update(OrderItem).where(
+        OrderItem.order_id == order_id,
+        OrderItem.nomenclature_id == nomenclature_id
+    ).values(
+        quantity=OrderItem.quantity + quantity,
+        price=price
+    ).returning(OrderItem.id, OrderItem.quantity))
+    return db.execute(stmt).first()
+
+def increment_order_total(db: Session, order_id: int, amount: Decimal) -> None:
+    """Увеличивает сумму и версию заказа инкрементом в SQL"""
+    stmt = lambda_stmt(lambda: update(Order).where(Order.id == order_id).values(
+        total_amount=Order.total_amount + amount,
+        version=Order.version + 1
+    ))
+    db.execute(stmt)
+
+def nomenclature_rows(db: Session, nomenclature_ids: Sequence[int]) -> List[Row]:
+    """Товары с категориями: поля товара и category_name, category_updated_at"""
+    ids = list(nomenclature_ids)
+    stmt = lambda_stmt(lambda: select(
+        Nomenclature.id, Nomenclature.name, Nomenclature.quantity, Nomenclature.price,
+        Nomenclature.category_id, Nomenclature.updated_at,
+        Category.name.label("category_name"),
+        Category.updated_at.label("category_updated_at")
+    ).outerjoin(
+        Category, Category.id == Nomenclature.category_id
+    ).where(Nomenclature.id.in_(ids)))
+    return db.execute(stmt).all()
+
+def order_rows(db: Session, order_ids: Sequence[int]) -> List[Row]:
+    """Заказы с клиентами: поля заказа (с version) и client_name, client_updated_at"""
+    ids = list(order_ids)
+    stmt = lambda_stmt(lambda: select(
+        Order.id, Order.client_id, Order.order_date, Order.status,
+        Order.total_amount, Order.version, Order.updated_at,
+        Client.name.label("client_name"),
+        Client.updated_at.label("client_updated_at")
+    ).outerjoin(
+        Client, Client.id == Order.client_id
+    ).where(Order.id.in_(ids)))
+    return db.execute(stmt).all()
+
+def order_item_rows(db: Session, order_ids: Sequence[int]) -> List[Row]:
+    """Позиции заказов с товарами: поля позиции и nomenclature_name, nomenclature_updated_at"""
+    ids = list(order_ids)
+    stmt = lambda_stmt(lambda: select(
+        OrderItem.id, OrderItem.order_id, OrderItem.nomenclature_id,
+        OrderItem.quantity, OrderItem.price,
+        Nomenclature.name.label("nomenclature_name"),
+        Nomenclature.updated_at.label("nomenclature_updated_at")
+    ).outerjoin(
+        Nomenclature, Nomenclature.id == OrderItem.nomenclature_id
+    ).where(OrderItem.order_id.in_(ids)).order_by(OrderItem.id))
+    return db.execute(stmt).all()
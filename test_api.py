@@ -1,12 +1,30 @@
+import asyncio
+import heapq
+import time
+import httpx
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
-from main import app
-from database import Base, get_db, Order, OrderItem, Nomenclature, Client, Category
+from main import app, create_app, _apply_add_item
+import repository
+import search_service
+import statements
+from config import Settings, settings
+from batch_loader import BatchLoader
+from cache_service import CacheService
+from cache_warmup import warm_up_cache
+from group_commit import GroupCommitWriter
+from admission_control import AdmissionController, AdmissionRejected, RouteLimiter
+from models import AddItemToOrderRequest
+from idempotency_service import purge_expired_keys
+from search_service import NomenclatureSearchIndex
+from database import Base, get_db, Order, OrderItem, Nomenclature, Client, Category, IdempotencyKey, ReplicaRouter, ShardRouter
 from decimal import Decimal
+from datetime import datetime, timedelta
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 engine = create_engine(
@@ -279,11 +297,807 @@ def test_cache_stats():
     data = response.json()
     assert "total_keys" in data
     assert "active_keys" in data
+    assert "expired_keys" in data
     assert "memory_usage_mb" in data
 
+def test_cache_stats_counters():
+    """Тест инкрементальных счетчиков кэша по префиксам"""
+    hits = []
+    cache = CacheService(on_hit=hits.append)
+    
+    async def run():
+        await cache.set("order_full:order_id:1", {"id": 1}, ttl=60)
+        await cache.set("order_full:order_id:2", {"id": 2}, ttl=60)
+        await cache.set("nomenclature_full:nomenclature_id:1", {"id": 1}, ttl=60)
+        await cache.get("order_full:order_id:1")
+        await cache.get("order_full:order_id:3")
+        cache._cache["order_full:order_id:2"]["expires_at"] = datetime.now() - timedelta(seconds=1)
+        await cache.get("order_full:order_id:2")
+        await cache.delete_pattern("nomenclature_full")
+        await cache.set("client:client_id:4", {"id": 4}, ttl=60)
+        expired_at = datetime.now() - timedelta(seconds=1)
+        cache._cache["client:client_id:4"]["expires_at"] = expired_at
+        heapq.heappush(cache._expiry_heap, (expired_at, "client:client_id:4"))
+    
+    asyncio.run(run())
+    stats = cache.get_cache_stats()
+    
+    assert hits == ["order_full"]
+    # Истекшая, но еще не запрошенная запись видна в expired_keys
+    assert (stats["total_keys"], stats["active_keys"], stats["expired_keys"]) == (2, 1, 1)
+    asyncio.run(cache.delete("client:client_id:4"))
+    stats = cache.get_cache_stats()
+    assert stats["expired_keys"] == 0
+    assert stats["total_keys"] == 1
+    assert stats["prefixes"]["order_full"] == {
+        "keys": 1,
+        "bytes": cache._cache["order_full:order_id:1"]["size"],
+        "hits": 1,
+        "misses": 2,
+        "evictions": 0,
+        "expirations": 1
+    }
+    assert stats["prefixes"]["nomenclature_full"]["evictions"] == 1
+    assert stats["prefixes"]["nomenclature_full"]["bytes"] == 0
+    
+    cache.clear()
+    assert cache.get_cache_stats()["memory_usage_mb"] == 0
+
 def test_clear_cache():
     """Тест очистки кэша"""
     response = client.post("/cache/clear")
     assert response.status_code == 200
     data = response.json()
     assert data["message"] == "Cache cleared successfully"
+
+def test_server_timing_header(setup_test_data):
+    """Тест разбивки времени запроса по фазам"""
+    test_data = setup_test_data
+    client.post("/cache/clear")
+    
+    response = client.get(f"/nomenclature/{test_data['nomenclature'].id}")
+    
+    assert response.status_code == 200
+    server_timing = response.headers["Server-Timing"]
+    for phase in ("cache", "db", "serialize", "total"):
+        assert f"{phase};dur=" in server_timing
+    
+    metrics_content = client.get("/metrics").text
+    assert "http_request_phase_duration_seconds" in metrics_content
+    assert 'endpoint="/nomenclature/{nomenclature_id}"' in metrics_content
+    assert f'endpoint="/nomenclature/{test_data["nomenclature"].id}",phase' not in metrics_content
+    
+    # Ответ из кэша: serialize включает валидацию response_model и кодирование
+    response = client.get(f"/nomenclature/{test_data['nomenclature'].id}")
+    assert "serialize;dur=" in response.headers["Server-Timing"]
+
+def test_profile_requires_admin_token():
+    """Тест закрытого доступа к профайлеру"""
+    response = client.get("/admin/profile", params={"seconds": 0.1})
+    assert response.status_code == 403
+
+def test_profile_returns_collapsed_stacks(monkeypatch):
+    """Тест профилирования воркера"""
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "test-admin-token")
+    
+    response = client.get(
+        "/admin/profile",
+        params={"seconds": 0.2, "interval_ms": 2},
+        headers={"X-Admin-Token": "test-admin-token"}
+    )
+    
+    assert response.status_code == 200
+    assert "text/plain" in response.headers["content-type"]
+    lines = response.text.strip().split("\n")
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert ";" in stack or "(" in stack
+    assert int(count) > 0
+
+def test_order_conditional_get(setup_test_data):
+    """Тест ETag и условного GET для заказа"""
+    test_data = setup_test_data
+    order_id = test_data['order'].id
+    client.post("/cache/clear")
+    
+    response = client.get(f"/orders/{order_id}")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    
+    response = client.get(f"/orders/{order_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+    
+    # После изменения заказа старый ETag больше не совпадает
+    client.post(
+        f"/orders/{order_id}/items",
+        json={
+            "order_id": order_id,
+            "nomenclature_id": test_data['nomenclature'].id,
+            "quantity": 1
+        }
+    )
+    response = client.get(f"/orders/{order_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()["items"]) == 1
+
+def test_nomenclature_conditional_get(setup_test_data):
+    """Тест ETag и условного GET для товара"""
+    test_data = setup_test_data
+    nomenclature_id = test_data['nomenclature'].id
+    client.post("/cache/clear")
+    
+    response = client.get(f"/nomenclature/{nomenclature_id}")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    
+    response = client.get(
+        f"/nomenclature/{nomenclature_id}",
+        headers={"If-None-Match": f'W/"other", {etag}'}
+    )
+    assert response.status_code == 304
+    
+    response = client.get(f"/nomenclature/{nomenclature_id}", headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+    assert response.json()["id"] == nomenclature_id
+
+def test_nomenclature_multi_get(setup_test_data):
+    """Тест получения нескольких товаров одним запросом"""
+    test_data = setup_test_data
+    client.post("/cache/clear")
+    
+    db = TestingSessionLocal()
+    second = Nomenclature(
+        name="Товар2",
+        quantity=0,
+        price=Decimal("2000.00"),
+        category_id=test_data['category'].id
+    )
+    db.add(second)
+    db.commit()
+    second_id = second.id
+    db.close()
+    
+    first_id = test_data['nomenclature'].id
+    response = client.get("/nomenclature", params={"ids": f"{second_id},999,{first_id},{second_id}"})
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["id"] for item in data] == [second_id, first_id]
+    assert data[1]["category_name"] == test_data['category'].name
+    
+    # Повторный запрос обслуживается из кэша
+    stats = client.get("/cache/stats").json()
+    assert stats["total_keys"] >= 2
+    
+    response = client.get("/nomenclature", params={"ids": "1,abc"})
+    assert response.status_code == 400
+
+def test_batch_loader_coalesces_concurrent_loads():
+    """Тест объединения параллельных загрузок в один вызов"""
+    calls = []
+    
+    async def batch_fn(keys, context):
+        calls.append((sorted(keys), context))
+        return {key: key * 10 for key in keys if key != 3}
+    
+    async def run():
+        loader = BatchLoader(batch_fn, window_ms=5, max_batch_size=100)
+        single = await asyncio.gather(
+            loader.load(1, "ctx-1"),
+            loader.load(2, "ctx-2"),
+            loader.load(1, "ctx-3"),
+            loader.load(3, "ctx-4")
+        )
+        many = await loader.load_many([4, 5, 4])
+        return single, many
+    
+    single, many = asyncio.run(run())
+    
+    assert single == [10, 20, 10, None]
+    assert many == {4: 40, 5: 50}
+    assert calls == [([1, 2, 3], "ctx-1"), ([4, 5], None)]
+
+def test_add_item_group_commit_mode(setup_test_data, monkeypatch):
+    """Тест добавления товара в режиме group commit"""
+    test_data = setup_test_data
+    monkeypatch.setattr(settings, "ADD_ITEM_WRITE_MODE", "group")
+    
+    payload = {
+        "order_id": test_data['order'].id,
+        "nomenclature_id": test_data['nomenclature'].id,
+        "quantity": 2
+    }
+    response1 = client.post(f"/orders/{test_data['order'].id}/items", json=payload)
+    response2 = client.post(f"/orders/{test_data['order'].id}/items", json=payload)
+    
+    assert response1.status_code == 200
+    assert "добавлен" in response1.json()["message"]
+    assert response2.status_code == 200
+    assert response2.json()["total_quantity"] == 4
+    
+    response = client.post("/orders/999/items", json={**payload, "order_id": 999})
+    assert response.status_code == 404
+
+def test_group_commit_writer_batches_writes(setup_test_data):
+    """Тест применения параллельных записей одной транзакцией"""
+    test_data = setup_test_data
+    order_id = test_data['order'].id
+    nomenclature_id = test_data['nomenclature'].id
+    
+    def add(quantity, target_nomenclature_id=nomenclature_id):
+        return AddItemToOrderRequest(
+            order_id=order_id,
+            nomenclature_id=target_nomenclature_id,
+            quantity=quantity
+        )
+    
+    batch_sizes = []
+    
+    async def run():
+        writer = GroupCommitWriter(
+            _apply_add_item,
+            max_batch_size=10,
+            interval_ms=20,
+            on_batch=batch_sizes.append
+        )
+        sessions = [TestingSessionLocal() for _ in range(4)]
+        try:
+            return await asyncio.gather(
+                writer.submit(sessions[0], order_id, add(1), 3),
+                writer.submit(sessions[1], order_id, add(2), 3),
+                writer.submit(sessions[2], order_id, add(1, 999), 3),
+                writer.submit(sessions[3], order_id, add(3), 3),
+                return_exceptions=True
+            )
+        finally:
+            for session in sessions:
+                session.close()
+    
+    results = asyncio.run(run())
+    
+    assert batch_sizes == [4]
+    assert [result.total_quantity for result in (results[0], results[1], results[3])] == [1, 3, 6]
+    assert isinstance(results[2], HTTPException)
+    assert results[2].status_code == 404
+    
+    db = TestingSessionLocal()
+    order = db.query(Order).filter(Order.id == order_id).first()
+    assert order.total_amount == Decimal("6000.00")
+    db.close()
+
+def test_add_item_increments_total_and_version(setup_test_data):
+    """Тест атомарного обновления суммы и версии заказа"""
+    test_data = setup_test_data
+    order_id = test_data['order'].id
+    
+    for quantity in (3, 2, 4):
+        response = client.post(
+            f"/orders/{order_id}/items",
+            json={
+                "order_id": order_id,
+                "nomenclature_id": test_data['nomenclature'].id,
+                "quantity": quantity
+            }
+        )
+        assert response.status_code == 200
+    
+    db = TestingSessionLocal()
+    order = db.query(Order).filter(Order.id == order_id).first()
+    items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
+    assert order.total_amount == Decimal("9000.00")
+    assert order.version == 4
+    assert len(items) == 1
+    assert items[0].quantity == 9
+    db.close()
+    
+    # Версия заказа входит в его ETag
+    assert "-r4-" in client.get(f"/orders/{order_id}").headers["ETag"]
+
+def test_replica_router_routes_reads(tmp_path):
+    """Тест маршрутизации чтений по репликам (две SQLite-базы)"""
+    replica_urls = [f"sqlite:///{tmp_path / 'replica1.db'}", f"sqlite:///{tmp_path / 'replica2.db'}"]
+    router = ReplicaRouter(replica_urls, strategy="round_robin", pin_seconds=60)
+    
+    def read_url(key=None):
+        session = router.read_session(key)
+        if session is None:
+            return "primary"
+        url = str(session.get_bind().url)
+        session.close()
+        return url
+    
+    assert [read_url() for _ in range(4)] == replica_urls * 2
+    
+    # После записи чтения заказа идут в primary, остальные — по-прежнему в реплики
+    db = TestingSessionLocal()
+    router.mark_written(("order", 1), db)
+    db.close()
+    assert read_url(("order", 1)) == "primary"
+    assert read_url(("order", 2)) in replica_urls
+    
+    expired_router = ReplicaRouter(replica_urls, pin_seconds=0)
+    db = TestingSessionLocal()
+    expired_router.mark_written(("order", 1), db)
+    db.close()
+    assert expired_router.read_session(("order", 1)) is not None
+
+def test_replica_router_least_loaded(tmp_path):
+    """Тест выбора наименее загруженной реплики"""
+    replica_urls = [f"sqlite:///{tmp_path / 'replica1.db'}", f"sqlite:///{tmp_path / 'replica2.db'}"]
+    router = ReplicaRouter(replica_urls, strategy="least_loaded")
+    
+    busy_connection = router.replicas[0].engine.connect()
+    try:
+        for _ in range(3):
+            session = router.read_session()
+            assert str(session.get_bind().url) == replica_urls[1]
+            session.close()
+    finally:
+        busy_connection.close()
+    
+    assert ReplicaRouter([]).read_session() is None
+
+def test_cache_snapshot_roundtrip(tmp_path):
+    """Тест сохранения и восстановления снимка кэша"""
+    snapshot_path = str(tmp_path / "cache.snapshot")
+    source = CacheService()
+    
+    async def fill():
+        await source.set("nomenclature_full:nomenclature_id:1", {"name": "Товар1"}, ttl=600, etag='"n-1-1"')
+        await source.set("order_full:order_id:1", [1, 2, 3], ttl=60)
+        await source.set("order_full:order_id:2", "expired", ttl=60)
+    
+    asyncio.run(fill())
+    source._cache["order_full:order_id:2"]["expires_at"] = datetime.now() - timedelta(seconds=1)
+    
+    assert source.save_snapshot(snapshot_path) == 2
+    
+    restored = CacheService()
+    assert restored.load_snapshot(snapshot_path) == 2
+    
+    entry = asyncio.run(restored.get_entry("nomenclature_full:nomenclature_id:1"))
+    assert entry["value"] == {"name": "Товар1"}
+    assert entry["etag"] == '"n-1-1"'
+    assert 590 < (entry["expires_at"] - datetime.now()).total_seconds() <= 600
+    assert asyncio.run(restored.get("order_full:order_id:1")) == [1, 2, 3]
+    assert asyncio.run(restored.get("order_full:order_id:2")) is None
+    
+    assert CacheService().load_snapshot(str(tmp_path / "missing.snapshot")) == 0
+
+def test_cache_warm_up(setup_test_data):
+    """Тест прогрева кэша горячими товарами и активными заказами"""
+    test_data = setup_test_data
+    client.post(
+        f"/orders/{test_data['order'].id}/items",
+        json={
+            "order_id": test_data['order'].id,
+            "nomenclature_id": test_data['nomenclature'].id,
+            "quantity": 2
+        }
+    )
+    
+    cache = CacheService()
+    db = TestingSessionLocal()
+    try:
+        result = asyncio.run(warm_up_cache([db], cache, settings))
+    finally:
+        db.close()
+    
+    assert result == {"nomenclature": 1, "orders": 1}
+    order_entry = asyncio.run(cache.get_entry(f"order_full:order_id:{test_data['order'].id}"))
+    assert order_entry["value"].items[0].quantity == 2
+    assert order_entry["etag"]
+    nomenclature_entry = asyncio.run(cache.get_entry(f"nomenclature_full:nomenclature_id:{test_data['nomenclature'].id}"))
+    assert nomenclature_entry["value"].name == test_data['nomenclature'].name
+
+def test_readiness_after_startup(monkeypatch, tmp_path):
+    """Тест readiness probe и снимка кэша при остановке"""
+    monkeypatch.setattr(settings, "CACHE_WARMUP_ENABLED", False)
+    monkeypatch.setattr(settings, "CACHE_SNAPSHOT_PATH", str(tmp_path / "cache.snapshot"))
+    
+    assert client.get("/health/ready").status_code == 503
+    with TestClient(app) as lifespan_client:
+        response = lifespan_client.get("/health/ready")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+    
+    assert (tmp_path / "cache.snapshot").exists()
+
+def test_create_app_isolated_instances():
+    """Тест независимых экземпляров приложения"""
+    app_settings = Settings()
+    app_settings.CACHE_WARMUP_ENABLED = False
+    first_app = create_app(app_settings)
+    second_app = create_app(app_settings)
+    
+    asyncio.run(first_app.state.resources.cache.set("order_full:order_id:1", "value"))
+    
+    with TestClient(first_app) as first_client, TestClient(second_app) as second_client:
+        assert first_client.get("/cache/stats").json()["total_keys"] == 1
+        assert second_client.get("/cache/stats").json()["total_keys"] == 0
+        
+        first_client.get("/health")
+        first_metrics = first_client.get("/metrics").text
+        second_metrics = second_client.get("/metrics").text
+        assert 'http_requests_total{endpoint="/health"' in first_metrics
+        assert 'endpoint="/health"' not in second_metrics
+    
+    assert first_app.state.resources.ready is False
+
+def test_add_item_idempotency_key(setup_test_data):
+    """Тест повтора добавления товара с тем же Idempotency-Key"""
+    test_data = setup_test_data
+    order_id = test_data['order'].id
+    payload = {
+        "order_id": order_id,
+        "nomenclature_id": test_data['nomenclature'].id,
+        "quantity": 2
+    }
+    headers = {"Idempotency-Key": "test-add-item-key"}
+    
+    response1 = client.post(f"/orders/{order_id}/items", json=payload, headers=headers)
+    response2 = client.post(f"/orders/{order_id}/items", json=payload, headers=headers)
+    assert response1.status_code == 200
+    assert response2.status_code == 200
+    assert response2.json() == response1.json()
+    assert response2.headers["Idempotent-Replayed"] == "true"
+    
+    # Без кэша в памяти ответ восстанавливается из таблицы idempotency_keys
+    app.state.resources.idempotency._entries.clear()
+    response3 = client.post(f"/orders/{order_id}/items", json=payload, headers=headers)
+    assert response3.json() == response1.json()
+    
+    response = client.post(
+        f"/orders/{order_id}/items",
+        json={**payload, "quantity": 5},
+        headers=headers
+    )
+    assert response.status_code == 422
+    
+    db = TestingSessionLocal()
+    item = db.query(OrderItem).filter(OrderItem.order_id == order_id).first()
+    order = db.query(Order).filter(Order.id == order_id).first()
+    assert item.quantity == 2
+    assert order.total_amount == Decimal("2000.00")
+    db.close()
+
+def test_idempotency_key_expires(setup_test_data):
+    """Тест истечения Idempotency-Key: повтор после TTL выполняется заново, истекшие строки удаляются"""
+    test_data = setup_test_data
+    order_id = test_data['order'].id
+    payload = {
+        "order_id": order_id,
+        "nomenclature_id": test_data['nomenclature'].id,
+        "quantity": 1
+    }
+    headers = {"Idempotency-Key": "test-expired-key"}
+    
+    assert client.post(f"/orders/{order_id}/items", json=payload, headers=headers).status_code == 200
+    
+    db = TestingSessionLocal()
+    db.query(IdempotencyKey).update({"created_at": datetime.utcnow() - timedelta(days=2)})
+    db.commit()
+    app.state.resources.idempotency._entries.clear()
+    
+    response = client.post(f"/orders/{order_id}/items", json=payload, headers=headers)
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    assert db.query(OrderItem).filter(OrderItem.order_id == order_id).first().quantity == 2
+    
+    db.query(IdempotencyKey).update({"created_at": datetime.utcnow() - timedelta(days=2)})
+    db.commit()
+    assert purge_expired_keys(db, ttl_seconds=86400) == 1
+    assert db.query(IdempotencyKey).count() == 0
+    db.close()
+
+def test_admission_control_sheds_by_deadline():
+    """Тест очереди admission control и отказа по бюджету клиента"""
+    shed = []
+    controller = AdmissionController(
+        limits={"get_order_info": 1},
+        max_queue=1,
+        default_timeout_ms=1000,
+        on_shed=lambda route, reason: shed.append(reason)
+    )
+    order = []
+    
+    async def call(name, timeout_ms, hold=0.05):
+        async with controller.slot("get_order_info", controller.deadline(timeout_ms)):
+            order.append(name)
+            await asyncio.sleep(hold)
+    
+    async def run():
+        first = asyncio.create_task(call("first", 1000))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(call("second", 1000))
+        await asyncio.sleep(0)
+        # Очередь заполнена: третий запрос отклоняется сразу
+        with pytest.raises(AdmissionRejected) as rejected:
+            await call("third", 1000)
+        await asyncio.gather(first, second)
+        return rejected.value
+    
+    rejected = asyncio.run(run())
+    assert order == ["first", "second"]
+    assert rejected.reason == "queue_full"
+    assert rejected.retry_after >= 1
+    assert shed == ["queue_full"]
+    
+    async def run_deadline():
+        first = asyncio.create_task(call("first", 1000, hold=0.2))
+        await asyncio.sleep(0)
+        # Ожидаемое ожидание (~0.05 с по оценке) больше бюджета в 1 мс
+        with pytest.raises(AdmissionRejected) as rejected:
+            await call("late", 1)
+        await first
+        return rejected.value
+    
+    assert asyncio.run(run_deadline()).reason == "deadline"
+    
+    # Отмена ожидающего после передачи ему слота возвращает слот
+    limiter = RouteLimiter("get_order_info", max_concurrency=1, max_queue=1)
+    
+    async def run_cancelled():
+        deadline = time.monotonic() + 1
+        await limiter.acquire(deadline)
+        waiter = asyncio.create_task(limiter.acquire(deadline))
+        await asyncio.sleep(0)
+        limiter.release()
+        waiter.cancel()
+        try:
+            # До Python 3.12 wait_for отдает уже полученный слот, игнорируя отмену
+            await waiter
+            limiter.release()
+        except asyncio.CancelledError:
+            pass
+        return await limiter.acquire(time.monotonic() + 0.01)
+    
+    assert asyncio.run(run_cancelled()) == 0.0
+
+def test_add_item_sheds_concurrent_requests(setup_test_data, monkeypatch):
+    """Тест 503 с Retry-After для параллельных добавлений сверх лимита слотов"""
+    test_data = setup_test_data
+    order_id = test_data['order'].id
+    payload = {"order_id": order_id, "nomenclature_id": test_data['nomenclature'].id, "quantity": 1}
+    controller = AdmissionController(limits={"add_item_to_order": 1}, max_queue=0, default_timeout_ms=1000)
+    monkeypatch.setattr(app.state.resources, "admission", controller)
+    
+    async def post_concurrently(count, key_prefix=None):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(*(
+                http.post(
+                    f"/orders/{order_id}/items",
+                    json=payload,
+                    headers={"Idempotency-Key": f"{key_prefix}-{i}"} if key_prefix else {}
+                )
+                for i in range(count)
+            ))
+    
+    # Запись идет в пуле потоков: пока первый запрос держит слот, остальные отклоняются
+    accepted = 0
+    for key_prefix in (None, "test-shed-key"):
+        responses = asyncio.run(post_concurrently(10, key_prefix))
+        statuses = [response.status_code for response in responses]
+        assert set(statuses) == {200, 503}
+        assert all(int(response.headers["Retry-After"]) >= 1 for response in responses if response.status_code == 503)
+        accepted += statuses.count(200)
+    
+    # В режиме group commit слот не берется: пачки собирает очередь писателя
+    monkeypatch.setattr(settings, "ADD_ITEM_WRITE_MODE", "group")
+    assert [response.status_code for response in asyncio.run(post_concurrently(10))] == [200] * 10
+    accepted += 10
+    
+    db = TestingSessionLocal()
+    assert db.query(OrderItem).filter(OrderItem.order_id == order_id).first().quantity == accepted
+    db.close()
+
+def test_nomenclature_search(setup_test_data, monkeypatch):
+    """Тест поиска товаров: ранжирование, фильтры и пагинация"""
+    test_data = setup_test_data
+    db = TestingSessionLocal()
+    subcategory = Category(name="Подкатегория", parent_id=test_data['category'].id)
+    db.add(subcategory)
+    db.commit()
+    db.add_all([
+        Nomenclature(name="Чехол для ноутбука", quantity=0, price=Decimal("500.00"), category_id=subcategory.id),
+        Nomenclature(name="Ноутбук Lenovo", quantity=5, price=Decimal("50000.00"), category_id=subcategory.id)
+    ])
+    db.commit()
+    
+    search_index = NomenclatureSearchIndex()
+    monkeypatch.setattr(app.state.resources, "search_index", search_index)
+    
+    # Пока индекс не построен, поиск идет через БД (lower() в SQLite понимает только латиницу)
+    response = client.get("/nomenclature/search", params={"q": "LENOVO"})
+    assert response.status_code == 200
+    assert "db;" in response.headers["Server-Timing"]
+    assert [item["name"] for item in response.json()["items"]] == ["Ноутбук Lenovo"]
+    
+    search_index.refresh(db)
+    response = client.get("/nomenclature/search", params={"q": "НОУТ"})
+    assert response.status_code == 200
+    assert "search;" in response.headers["Server-Timing"]
+    data = response.json()
+    assert data["total"] == 2
+    assert [item["name"] for item in data["items"]] == ["Ноутбук Lenovo", "Чехол для ноутбука"]
+    
+    response = client.get("/nomenclature/search", params={"q": "ноут", "in_stock": True})
+    assert [item["name"] for item in response.json()["items"]] == ["Ноутбук Lenovo"]
+    
+    response = client.get("/nomenclature/search", params={
+        "q": "ноут", "category_id": test_data['category'].id, "limit": 1, "offset": 1
+    })
+    assert response.json()["total"] == 2
+    assert [item["name"] for item in response.json()["items"]] == ["Чехол для ноутбука"]
+    
+    # Короткий запрос ищет по началу слов
+    response = client.get("/nomenclature/search", params={"q": "le"})
+    assert [item["name"] for item in response.json()["items"]] == ["Ноутбук Lenovo"]
+    
+    total, items = repository.search_nomenclature(db, "lenovo", category_id=subcategory.id)
+    assert total == 1
+    assert items[0].name == "Ноутбук Lenovo"
+    db.close()
+
+def test_search_index_rebuilds_on_bulk_change(setup_test_data, monkeypatch):
+    """Тест обновления индекса: массовое изменение каталога перестраивает индекс вне блокировки"""
+    db = TestingSessionLocal()
+    search_index = NomenclatureSearchIndex()
+    search_index.refresh(db)
+    rebuilds = []
+    rebuild = search_index.rebuild
+    monkeypatch.setattr(search_index, "rebuild", lambda session: (rebuilds.append(1), rebuild(session)))
+    
+    db.add(Nomenclature(name="Монитор Dell", quantity=1, price=Decimal("100.00"), category_id=setup_test_data['category'].id))
+    db.commit()
+    search_index.refresh(db)
+    assert rebuilds == []
+    assert search_index.search("монитор")[0] == 1
+    
+    monkeypatch.setattr(search_service, "REBUILD_MIN_CHANGED", 0)
+    db.query(Nomenclature).update({"price": Nomenclature.price + 1})
+    db.commit()
+    search_index.refresh(db)
+    assert rebuilds == [1]
+    assert search_index.size == 2
+    db.close()
+
+def test_sharded_orders(tmp_path):
+    """Тест шардирования заказов по client_id на двух SQLite-базах"""
+    shard_urls = [f"sqlite:///{tmp_path}/shard{shard}.db" for shard in range(2)]
+    app_settings = Settings()
+    app_settings.CACHE_WARMUP_ENABLED = False
+    app_settings.SHARD_DATABASE_URLS = ",".join(shard_urls)
+    sharded_app = create_app(app_settings)
+    router = sharded_app.state.resources.database.shard_router
+    for shard_engine in router.engines:
+        Base.metadata.create_all(bind=shard_engine)
+    
+    db = router.session(0)
+    category = Category(name="Категория1")
+    db.add(category)
+    db.flush()
+    db.add(Nomenclature(id=1, name="Товар1", quantity=100, price=Decimal("10.00"), category_id=category.id))
+    db.add_all([Client(id=1, name="Клиент1", address="Адрес1"), Client(id=2, name="Клиент2", address="Адрес2")])
+    db.commit()
+    db.close()
+    assert router.replicate_reference_data() == {"categories": 1, "nomenclature": 1, "clients": 2}
+    
+    # Клиент 1 живет в шарде 1, клиент 2 — в шарде 0; ID заказов выдаются по шардам
+    for order_id, client_id in ((2, 1), (1, 2)):
+        shard = router.shard_for_client(client_id)
+        assert router.shard_for_order(order_id) == shard
+        db = router.session(shard)
+        db.add(Order(id=order_id, client_id=client_id, total_amount=Decimal("0.00")))
+        db.commit()
+        db.close()
+    
+    with TestClient(sharded_app) as sharded_client:
+        for order_id, quantity in ((2, 3), (1, 1)):
+            response = sharded_client.post(
+                f"/orders/{order_id}/items",
+                json={"order_id": order_id, "nomenclature_id": 1, "quantity": quantity}
+            )
+            assert response.status_code == 200
+        
+        assert sharded_client.get("/orders/2").json()["total_amount"] == "30.00"
+        totals = sharded_client.get("/clients/totals").json()
+        assert [(row["client_name"], row["total_amount"]) for row in totals] == [
+            ("Клиент1", "30.00"), ("Клиент2", "10.00")
+        ]
+    
+    db = router.session(1)
+    assert db.query(OrderItem).filter(OrderItem.order_id == 2).one().quantity == 3
+    assert db.query(OrderItem).filter(OrderItem.order_id == 1).first() is None
+    db.close()
+    
+    # Прогрев читает продажи и заказы всех шардов
+    shards = [router.session(shard) for shard in range(router.shard_count)]
+    cache = CacheService()
+    try:
+        assert asyncio.run(warm_up_cache(shards, cache, app_settings)) == {"nomenclature": 1, "orders": 2}
+    finally:
+        for db in shards:
+            db.close()
+    assert asyncio.run(cache.get("order_full:order_id:2")).items[0].quantity == 3
+    
+    # Инкрементальная синхронизация копирует только измененные справочники
+    db = router.session(0)
+    db.add(Client(id=3, name="Клиент3", address="Адрес3"))
+    db.commit()
+    db.close()
+    copied = router.replicate_reference_data(incremental=True)
+    assert copied["categories"] == 0
+    db = router.session(1)
+    assert db.query(Client).filter(Client.id == 3).one().name == "Клиент3"
+    db.close()
+    
+    lookup_router = ShardRouter(shard_urls, id_scheme="lookup")
+    assert lookup_router.shard_for_order(2) == 1
+    assert lookup_router.shard_for_order(999) is None
+    lookup_router.dispose()
+
+def test_statements_bind_closure_values(setup_test_data):
+    """Тест готовых выражений: значения из замыкания передаются параметрами"""
+    test_data = setup_test_data
+    db = TestingSessionLocal()
+    other = Nomenclature(name="Товар2", quantity=0, price=Decimal("5.00"), category_id=test_data['category'].id)
+    db.add(other)
+    db.commit()
+    
+    assert statements.order_exists(db, test_data['order'].id)
+    assert not statements.order_exists(db, 999)
+    assert statements.nomenclature_stock(db, test_data['nomenclature'].id).quantity == 100
+    assert statements.nomenclature_stock(db, other.id).quantity == 0
+    
+    rows = statements.nomenclature_rows(db, [test_data['nomenclature'].id, other.id])
+    assert sorted(row.name for row in rows) == ["Товар1", "Товар2"]
+    info, etag = repository.nomenclature_info_from_row(rows[0])
+    nomenclature = db.query(Nomenclature).filter(Nomenclature.id == info.id).first()
+    assert (info, etag) == repository.build_nomenclature_info(nomenclature, nomenclature.category)
+    db.close()
+
+def test_group_commit_writer_survives_broken_connection(setup_test_data):
+    """Тест: сбой commit и rollback не оставляет запросы без ответа"""
+    test_data = setup_test_data
+    order_id = test_data['order'].id
+    request = AddItemToOrderRequest(order_id=order_id, nomenclature_id=test_data['nomenclature'].id, quantity=1)
+    
+    class BrokenSession:
+        def __init__(self, session):
+            self._session = session
+        
+        def __getattr__(self, name):
+            return getattr(self._session, name)
+        
+        def commit(self):
+            raise ConnectionError("connection lost")
+        
+        def rollback(self):
+            raise ConnectionError("connection lost")
+    
+    def failing_on_batch(batch_size):
+        raise ValueError("metrics down")
+    
+    async def run():
+        writer = GroupCommitWriter(_apply_add_item, max_batch_size=10, interval_ms=5, on_batch=failing_on_batch)
+        broken = BrokenSession(TestingSessionLocal())
+        healthy = TestingSessionLocal()
+        try:
+            first = await asyncio.wait_for(
+                asyncio.gather(writer.submit(broken, order_id, request, 3), return_exceptions=True), 5
+            )
+            broken._session.close()
+            # Писатель продолжает работать после сбоя пачки
+            second = await asyncio.wait_for(writer.submit(healthy, order_id, request, 3), 5)
+            return first[0], second
+        finally:
+            healthy.close()
+    
+    failed, succeeded = asyncio.run(run())
+    assert isinstance(failed, ConnectionError)
+    assert succeeded.success
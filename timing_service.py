@@ -0,0 +1,73 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Iterator
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Фазы текущего запроса. В контексте хранится изменяемый словарь: эндпоинт
+# выполняется в копии контекста (BaseHTTPMiddleware запускает его в отдельной
+# задаче), поэтому новое значение переменной до middleware бы не дошло,
+# а изменения общего словаря доходят.
+_request_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_phases", default=None)
+# Момент возврата из эндпоинта (список, чтобы его видел и синхронный эндпоинт в пуле потоков)
+_endpoint_done: ContextVar[Optional[List[float]]] = ContextVar("endpoint_done", default=None)
+
+class TimingService:
+    def start_request(self) -> Dict[str, float]:
+        """Начинает сбор фаз для нового запроса"""
+        phases: Dict[str, float] = {}
+        _request_phases.set(phases)
+        return phases
+
+    def add_phase(self, name: str, duration: float) -> None:
+        """Добавляет длительность фазы (в секундах) к текущему запросу"""
+        phases = _request_phases.get()
+        if phases is None:
+            return
+        phases[name] = phases.get(name, 0.0) + duration
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Замеряет время выполнения блока как фазу текущего запроса"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def mark_endpoint_done(self) -> None:
+        """Отмечает возврат из эндпоинта (см. serialize_after_endpoint)"""
+        marks = _endpoint_done.get()
+        if marks is not None:
+            marks.append(time.perf_counter())
+
+    @contextmanager
+    def serialize_after_endpoint(self) -> Iterator[None]:
+        """
+        Учитывает в фазе serialize время блока после mark_endpoint_done():
+        валидацию response_model, jsonable_encoder и JSON-кодирование ответа.
+        """
+        marks: List[float] = []
+        token = _endpoint_done.set(marks)
+        try:
+            yield
+        finally:
+            _endpoint_done.reset(token)
+            if marks:
+                self.add_phase("serialize", time.perf_counter() - marks[-1])
+
+    def get_phases(self) -> Dict[str, float]:
+        """Возвращает фазы текущего запроса"""
+        return dict(_request_phases.get() or {})
+
+    def format_server_timing(self, phases: Dict[str, float], total: Optional[float] = None) -> str:
+        """Формирует значение заголовка Server-Timing (длительности в мс)"""
+        parts = [f"{name};dur={duration * 1000:.3f}" for name, duration in phases.items()]
+        if total is not None:
+            parts.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(parts)
+
+# Глобальный экземпляр сервиса замеров
+timing_service = TimingService()